@@ -16,35 +16,237 @@
 """Checkpointing-related utilities to handle TrainState instances."""
 
 import asyncio
+import atexit
+import bisect
 from concurrent import futures
+import dataclasses
 import enum
+import functools
+import hashlib
+import json
 import os
 import re
-from typing import Optional
+import threading
+from typing import Any, Awaitable, Dict, List, Optional, Sequence, Tuple
 
 from absl import logging
-from flax import jax_utils
+from flax import serialization
 from flax.training import checkpoints
 import jax
 from jax.experimental import maps
+import jax.numpy as jnp
 from jax.experimental.gda_serialization import serialization as gda_serialization
 # Internal import
 from lingvo.jax import py_utils
+from lingvo.jax import pytypes
 from lingvo.jax import train_states
+import numpy as np
 import tensorflow.compat.v2 as tf
+import tensorstore as ts
+
+JTensor = pytypes.JTensor
+PyTreeDef = pytypes.PyTreeDef
 
 _CHECKPOINT_DIR_PREFIX = 'checkpoint_'
 _TMP_DIR_KEYWORD = '.tmp'
+# Prefix of the metadata files describing the structure of Flax checkpoints. It
+# must differ from the `checkpoint_` prefix of the Flax checkpoint files.
+_FLAX_METADATA_PREFIX = 'metadata_'
+# Value of `precision` to store model variables as bfloat16.
+_BFLOAT16_PRECISION = 'bfloat16'
 CHECKPOINT_SUBDIR_RE = re.compile(r'checkpoint_[\d]+$')
 TMP_CHECKPOINT_SUBDIR_RE = re.compile(r'checkpoint_[\d]+.tmp_[\d]+$')
 
+# Latest checkpoint step saved by this process, keyed by checkpoint dir. This
+# avoids listing (potentially remote) checkpoint dirs on every save.
+_LATEST_STEP_CACHE: Dict[str, int] = {}
+
+# Sorted steps of the Flax metadata files in each checkpoint dir. It is seeded
+# by listing the dir on the first save there, then maintained in memory.
+_FLAX_METADATA_STEPS: Dict[str, List[int]] = {}
+
+# Single background worker flushing Flax checkpoints to storage, so that the
+# training loop only blocks on the device-to-host transfer.
+_SAVE_EXECUTOR = futures.ThreadPoolExecutor(max_workers=1)
+_PENDING_SAVE: Optional[futures.Future] = None
+
+
+def _wait_for_pending_save() -> None:
+  """Blocks until the in-flight asynchronous checkpoint save (if any) is done.
+
+  Any exception raised while writing the checkpoint is re-raised here.
+  """
+  global _PENDING_SAVE
+  if _PENDING_SAVE is not None:
+    pending_save, _PENDING_SAVE = _PENDING_SAVE, None
+    pending_save.result()
+
+
+atexit.register(_wait_for_pending_save)
+
+# Background workers deleting stale GDA checkpoint step dirs (on process 0
+# only), so that retention does not block the training loop.
+_DELETE_EXECUTOR = futures.ThreadPoolExecutor(max_workers=4)
+_PENDING_DELETES: List[futures.Future] = []
+
+# Sorted steps of the committed GDA checkpoints in each checkpoint dir. It is
+# seeded by listing the dir once, then maintained in memory on each commit.
+_GDA_CHECKPOINT_STEPS: Dict[str, List[int]] = {}
+
+
+def _wait_for_pending_deletes() -> None:
+  """Blocks until all the in-flight checkpoint deletions are done."""
+  futures.wait(_PENDING_DELETES)
+  _PENDING_DELETES.clear()
+
+
+atexit.register(_wait_for_pending_deletes)
+
+# Event loop, running in a daemon thread, on which all the GDA (de)serialization
+# coroutines are executed. It is created once and reused across checkpoints.
+_CHECKPOINT_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_CHECKPOINT_LOOP_LOCK = threading.Lock()
+
+
+def _get_checkpoint_loop() -> asyncio.AbstractEventLoop:
+  """Returns the persistent checkpointing event loop, starting it if needed."""
+  global _CHECKPOINT_LOOP
+  with _CHECKPOINT_LOOP_LOCK:
+    if _CHECKPOINT_LOOP is None:
+      loop = asyncio.new_event_loop()
+      threading.Thread(
+          target=loop.run_forever, name='checkpoint_loop', daemon=True).start()
+      _CHECKPOINT_LOOP = loop
+  return _CHECKPOINT_LOOP
+
+
+def _submit_coroutine(coroutine: Awaitable[Any]) -> futures.Future:
+  """Schedules `coroutine` on the checkpointing event loop."""
+  return asyncio.run_coroutine_threadsafe(coroutine, _get_checkpoint_loop())
+
+
+def _run_coroutine(coroutine: Awaitable[Any]) -> Any:
+  """Runs `coroutine` on the checkpointing event loop and waits for it."""
+  return _submit_coroutine(coroutine).result()
+
+
+@dataclasses.dataclass(frozen=True)
+class _GdaHostSnapshot:
+  """Host copy of the shards of a GDA that this process is responsible for.
+
+  Attributes:
+    metadata: The tensorstore metadata of the global array.
+    shards: A list of (index, host_array) pairs, one per local shard with
+      replica_id 0, where `index` locates the shard in the global array.
+  """
+  metadata: Dict[str, Any]
+  shards: List[Tuple[Tuple[slice, ...], np.ndarray]]
+
+
+@dataclasses.dataclass(frozen=True)
+class _PendingGdaSave:
+  """GDA checkpoint being written in the background, not yet committed."""
+  future: futures.Future
+  checkpoint_dir: str
+  checkpoint_step_tmp_dir: str
+  checkpoint_step_dir: str
+  step: int
+  max_checkpoints: int
+
+
+# GDA checkpoint whose shards are being written by the checkpointing event loop.
+# It is committed, i.e. renamed to its final location, by
+# `maybe_commit_checkpoint()` once written on all processes, or by the next call
+# to `_commit_pending_gda_save()`.
+_PENDING_GDA_SAVE: Optional[_PendingGdaSave] = None
+
+
+@dataclasses.dataclass
+class _CommitCheck:
+  """In-flight collective checking if all processes wrote the GDA checkpoint.
+
+  Attributes:
+    all_done: The per-device result of the collective, not fetched yet: 1 if
+      all the processes had written their shards when it was launched.
+    calls_left: The number of `maybe_commit_checkpoint()` calls left before
+      `all_done` is fetched.
+  """
+  all_done: JTensor
+  calls_left: int
+
+
+# Check launched by `maybe_commit_checkpoint()` for `_PENDING_GDA_SAVE`.
+_PENDING_COMMIT_CHECK: Optional[_CommitCheck] = None
+# Number of `maybe_commit_checkpoint()` calls, i.e. of training steps, after
+# which the result of a commit check is fetched. The train steps dispatched
+# before the check have then completed, so fetching it does not stall the host.
+_COMMIT_CHECK_DELAY_STEPS = 10
+
+# Maximum number of GDA leaves concurrently (de)serialized. This bounds the
+# number of open files and in-flight requests on the checkpoint storage.
+_GDA_IO_CONCURRENCY = 32
+# Maximum number of concurrent file I/O operations in the tensorstore context
+# shared by all the GDA checkpoint writes.
+_TS_FILE_IO_CONCURRENCY = 128
+
+
+@functools.lru_cache(maxsize=None)
+def _get_ts_context() -> ts.Context:
+  """Returns the tensorstore context shared across GDA checkpoint writes."""
+  return ts.Context(
+      {'file_io_concurrency': {
+          'limit': _TS_FILE_IO_CONCURRENCY
+      }})
 
-def _is_checkpoint_dir(x: str) -> bool:
-  return bool(CHECKPOINT_SUBDIR_RE.match(x))
 
+async def _gather_with_concurrency_limit(
+    coroutines: Sequence[Awaitable[Any]]) -> List[Any]:
+  """Like `asyncio.gather()`, but with at most `_GDA_IO_CONCURRENCY` running."""
+  # Created here so that it is bound to the running (checkpointing) event loop.
+  semaphore = asyncio.Semaphore(_GDA_IO_CONCURRENCY)
 
-def _is_tmp_checkpoint_dir(x: str) -> bool:
-  return bool(TMP_CHECKPOINT_SUBDIR_RE.match(x))
+  async def run(coroutine):
+    async with semaphore:
+      return await coroutine
+
+  return await asyncio.gather(*[run(c) for c in coroutines])
+
+
+def _split_checkpoint_dirnames(
+    dirnames: Sequence[str]) -> Tuple[List[str], List[str]]:
+  """Splits checkpoint dirnames into final and tmp ones in a single pass.
+
+  This matches `CHECKPOINT_SUBDIR_RE` and `TMP_CHECKPOINT_SUBDIR_RE` using plain
+  string operations, which is much cheaper than regexes on large listings.
+
+  Args:
+    dirnames: The content of a checkpoint directory (dirnames only).
+
+  Returns:
+    A tuple (final_dirnames, tmp_dirnames). Other entries are discarded.
+  """
+  final_dirnames = []
+  tmp_dirnames = []
+  prefix_len = len(_CHECKPOINT_DIR_PREFIX)
+  for x in dirnames:
+    if not x.startswith(_CHECKPOINT_DIR_PREFIX):
+      continue
+    tail = x[prefix_len:]
+    if tail.isdecimal():
+      final_dirnames.append(x)
+      continue
+    step, sep, suffix = tail.partition(f'{_TMP_DIR_KEYWORD}_')
+    if sep and step.isdecimal() and suffix.isdecimal():
+      tmp_dirnames.append(x)
+  return final_dirnames, tmp_dirnames
+
+
+def _listdir(dirname: str) -> List[str]:
+  """Lists `dirname`, bypassing the TF filesystem layer for local paths."""
+  if '://' in dirname:
+    return tf.io.gfile.listdir(dirname)
+  with os.scandir(dirname) as entries:
+    return [entry.name for entry in entries]
 
 
 def _make_checkpoint_step_dir(
@@ -79,10 +281,17 @@ def save_checkpoint(train_state: train_states.TrainState,
                     unreplicate: bool = True,
                     checkpoint_type: CheckpointType = CheckpointType.FLAX,
                     state_specs: Optional[train_states.TrainState] = None,
-                    max_checkpoints: int = 10) -> None:
+                    max_checkpoints: int = 10,
+                    precision: Optional[str] = None) -> None:
   """Saves a checkpoint into the provided base directory.
 
-  This is typically called on a replicated TrainState instance.
+  This is typically called on a replicated TrainState instance. Checkpoints
+  are written asynchronously: the call returns once the train state has been
+  copied to host memory, and the write is completed before the next save or
+  restore call (or at interpreter exit). Flax checkpoints are also completed
+  before `latest_checkpoint()` calls. GDA checkpoints are committed shortly
+  after having been written by `maybe_commit_checkpoint()`, or at the latest
+  by the next save, restore or `checkpoint_wait()` call.
 
   Args:
     train_state: The TrainState instance to save.
@@ -95,24 +304,33 @@ def save_checkpoint(train_state: train_states.TrainState,
       must be `CheckpointType.FLAX`.
     state_specs: Currently unused.
     max_checkpoints: The number of past checkpoint files to keep.
+    precision: Optional lower precision in which to store the floating point
+      model variables, to reduce checkpoint size. Currently, it must be None
+      (full precision) or 'bfloat16', the latter being only supported for Flax
+      checkpoints. Variables are cast back to their original dtype on restore.
 
   Raises:
     ValueError: If the global step has an unexpected shape, if `state_specs`
     is not specified for persistence-based checkpointing or if
-    `checkpoint_type` is invalid.
+    `checkpoint_type` or `precision` is invalid.
   """
   del state_specs
 
+  if precision not in (None, _BFLOAT16_PRECISION):
+    raise ValueError(f'Unexpected precision `{precision}`.')
+
   if jax.config.jax_parallel_functions_output_gda:
-    step = int(jax.device_get(py_utils.maybe_unreplicate_gda(train_state.step)))
+    if precision is not None:
+      raise ValueError('`precision` is not supported for GDA checkpoints.')
+    step = int(py_utils.maybe_unreplicate_gda(train_state.step))
     _save_checkpoint_gda(train_state, checkpoint_dir, overwrite,
                          max_checkpoints, step)
     return
 
   if train_state.step.ndim == 0:
-    step = jax.device_get(train_state.step)
+    step = int(train_state.step)
   elif train_state.step.ndim == 1:
-    step = jax.device_get(train_state.step[0])
+    step = int(_get_first_replica(train_state.step))
   else:
     raise ValueError(
         f'Expecting a replicated 1D global step (got `{train_state.step.ndim}`).'
@@ -120,7 +338,7 @@ def save_checkpoint(train_state: train_states.TrainState,
 
   if checkpoint_type == CheckpointType.FLAX:
     _save_checkpoint_flax(train_state, checkpoint_dir, overwrite, unreplicate,
-                          max_checkpoints, step)
+                          max_checkpoints, step, precision)
   else:
     raise ValueError(f'Unexpected checkpoint_type `{checkpoint_type}`.')
 
@@ -134,9 +352,56 @@ def latest_checkpoint(checkpoint_dir: str) -> Optional[str]:
   Returns:
     Path to latest checkpoint or None if there is no checkpoint.
   """
+  _wait_for_pending_save()
   return checkpoints.latest_checkpoint(checkpoint_dir)
 
 
+def maybe_commit_checkpoint() -> None:
+  """Commits the pending GDA checkpoint once all processes have written it.
+
+  This is meant to be called at every training step, so that a GDA checkpoint
+  is committed shortly after having been written, rather than at the next save.
+  Unlike `checkpoint_wait()`, it never waits for the background writes. In
+  multi-process jobs, whether all processes are done is checked by a collective
+  whose result is only fetched `_COMMIT_CHECK_DELAY_STEPS` calls later, so that
+  the host does not wait for the train steps dispatched before it. The
+  checkpoint is then committed, which barriers across processes once.
+
+  This must be called by all processes in sync, like `save_checkpoint()`.
+  """
+  global _PENDING_COMMIT_CHECK
+  if _PENDING_GDA_SAVE is None:
+    return
+  if jax.process_count() == 1:
+    if _PENDING_GDA_SAVE.future.done():
+      _commit_pending_gda_save()
+    return
+  if _PENDING_COMMIT_CHECK is None:
+    _PENDING_COMMIT_CHECK = _CommitCheck(
+        all_done=_launch_all_processes_done_check(
+            _PENDING_GDA_SAVE.future.done()),
+        calls_left=_COMMIT_CHECK_DELAY_STEPS)
+    return
+  _PENDING_COMMIT_CHECK.calls_left -= 1
+  if _PENDING_COMMIT_CHECK.calls_left > 0:
+    return
+  check, _PENDING_COMMIT_CHECK = _PENDING_COMMIT_CHECK, None
+  if int(jax.device_get(check.all_done)[0]):
+    _commit_pending_gda_save()
+
+
+def checkpoint_wait() -> None:
+  """Waits for in-flight checkpoint saves to be fully written and committed.
+
+  This also waits for the deletion of the stale checkpoints. For GDA
+  checkpoints, this must be called by all processes in sync, like
+  `save_checkpoint()`.
+  """
+  _wait_for_pending_save()
+  _commit_pending_gda_save()
+  _wait_for_pending_deletes()
+
+
 def restore_checkpoint(train_state: train_states.TrainState,
                        checkpoint_dir: str,
                        global_mesh: Optional[maps.Mesh],
@@ -162,12 +427,15 @@ def restore_checkpoint(train_state: train_states.TrainState,
     A restored `TrainState` instance.
 
   Raises:
-    ValueError: When a mismatch between the current checkpoint structure and
-    the saved checkpoint one is detected.
+    ValueError: When a mismatch between the current checkpoint structure or
+    dtypes and the saved checkpoint ones is detected. Variables saved with the
+    bfloat16 `precision` are cast back to their floating point dtype instead.
   """
   del state_specs  # Unused.
+  _wait_for_pending_save()
 
   if jax.config.jax_parallel_functions_output_gda:
+    _commit_pending_gda_save()
     return _restore_checkpoint_gda(train_state, checkpoint_dir, global_mesh,
                                    mesh_axes, step)
 
@@ -181,43 +449,222 @@ def restore_checkpoint(train_state: train_states.TrainState,
     raise ValueError(f'Unexpected checkpoint_type `{checkpoint_type}`.')
 
 
+@functools.lru_cache(maxsize=None)
+def _treedef_signature(treedef: PyTreeDef) -> str:
+  """Returns a short hash of the serialized pytree structure `treedef`."""
+  return hashlib.blake2b(str(treedef).encode(), digest_size=16).hexdigest()
+
+
+def _make_flax_metadata_path(checkpoint_dir: str, step: int) -> str:
+  return os.path.join(checkpoint_dir, f'{_FLAX_METADATA_PREFIX}{step}.json')
+
+
+def _list_flax_metadata_steps(checkpoint_dir: str) -> List[int]:
+  """Returns the sorted steps of the Flax metadata files in `checkpoint_dir`."""
+  steps = []
+  prefix_len = len(_FLAX_METADATA_PREFIX)
+  for x in _listdir(checkpoint_dir):
+    if x.startswith(_FLAX_METADATA_PREFIX) and x.endswith('.json'):
+      step = x[prefix_len:-len('.json')]
+      if step.isdecimal():
+        steps.append(int(step))
+  return sorted(steps)
+
+
+def _delete_stale_flax_metadata(checkpoint_dir: str, step: int, keep: int,
+                                overwrite: bool) -> None:
+  """Deletes the metadata of the checkpoints removed by Flax when saving `step`.
+
+  This mirrors the Flax retention policy, without listing `checkpoint_dir`:
+  Flax removes the checkpoints newer than `step` when overwriting, then keeps
+  the `keep` latest ones.
+
+  Args:
+    checkpoint_dir: The base directory the checkpoint has been saved into.
+    step: The step of the checkpoint that has just been saved.
+    keep: The number of past checkpoint files to keep.
+    overwrite: Whether existing checkpoints files have been overwritten.
+  """
+  metadata_steps = _FLAX_METADATA_STEPS[checkpoint_dir]
+  stale_steps = []
+  if overwrite:
+    stale_steps = [x for x in metadata_steps if x > step]
+    metadata_steps = [x for x in metadata_steps if x <= step]
+  if step not in metadata_steps:
+    metadata_steps.append(step)
+    metadata_steps.sort()
+  if len(metadata_steps) > keep:
+    stale_steps.extend(metadata_steps[:-keep])
+    metadata_steps = metadata_steps[-keep:]
+  _FLAX_METADATA_STEPS[checkpoint_dir] = metadata_steps
+  for x in stale_steps:
+    try:
+      tf.io.gfile.remove(_make_flax_metadata_path(checkpoint_dir, x))
+    except tf.errors.NotFoundError:
+      # Already removed along with its checkpoint, e.g. from another job.
+      pass
+
+
+def _write_flax_checkpoint(checkpoint_dir: str, checkpoint_target: Any,
+                           metadata: Dict[str, Any], step: int, keep: int,
+                           overwrite: bool) -> None:
+  """Writes a Flax checkpoint and records it as the latest one on success.
+
+  The small `metadata` file is written first, so that any checkpoint saved
+  with it can be checked against a train state before being read.
+
+  Args:
+    checkpoint_dir: The base directory to save the checkpoint into.
+    checkpoint_target: The Flax checkpoint target to save.
+    metadata: The structure of the saved train state.
+    step: The step of the checkpoint.
+    keep: The number of past checkpoint files to keep.
+    overwrite: Whether to overwrite existing checkpoints files.
+  """
+  tf.io.gfile.makedirs(checkpoint_dir)
+  if checkpoint_dir not in _FLAX_METADATA_STEPS:
+    _FLAX_METADATA_STEPS[checkpoint_dir] = _list_flax_metadata_steps(
+        checkpoint_dir)
+  with tf.io.gfile.GFile(_make_flax_metadata_path(checkpoint_dir, step),
+                         'w') as f:
+    f.write(json.dumps(metadata))
+  checkpoints.save_checkpoint(
+      checkpoint_dir, checkpoint_target, step, keep=keep, overwrite=overwrite)
+  _LATEST_STEP_CACHE[checkpoint_dir] = step
+  _delete_stale_flax_metadata(checkpoint_dir, step, keep, overwrite)
+
+
+def _check_flax_metadata(checkpoint_dir: str, step: int,
+                         pytree_state: PyTreeDef) -> None:
+  """Checks a train state against the metadata of a Flax checkpoint, if any.
+
+  This allows failing early, before the checkpoint itself has been read.
+
+  Args:
+    checkpoint_dir: The base directory to restore the checkpoint from.
+    step: The step of the checkpoint to restore.
+    pytree_state: The treedef of the train state to restore.
+
+  Raises:
+    ValueError: If the checkpoint structure does not match the train state.
+  """
+  metadata_path = _make_flax_metadata_path(checkpoint_dir, step)
+  if not tf.io.gfile.exists(metadata_path):
+    # Checkpoints written before metadata files were introduced.
+    return
+  with tf.io.gfile.GFile(metadata_path, 'r') as f:
+    metadata = json.loads(f.read())
+  saved_signature = metadata['pytree_hash']
+  signature = _treedef_signature(pytree_state)
+  if saved_signature != signature:
+    raise ValueError(
+        'Unable to restore checkpoint. A mismatch between the saved '
+        'checkpoint structure and the current one has been detected '
+        f'(`{saved_signature}` vs `{signature}`).')
+
+
+def _cast_mdl_vars_to_bfloat16(flattened_state: List[Any],
+                               treedef: PyTreeDef) -> List[Any]:
+  """Casts the floating point host model variables of a flattened TrainState."""
+
+  def cast(x):
+    if np.issubdtype(x.dtype, np.floating) and x.dtype.itemsize > 2:
+      return x.astype(jnp.bfloat16)
+    return x
+
+  state = jax.tree_unflatten(treedef, flattened_state)
+  state = state.replace(mdl_vars=jax.tree_map(cast, state.mdl_vars))
+  return jax.tree_leaves(state)
+
+
+def _get_first_replica(x: Any) -> Any:
+  """Returns the first replica of a pmap-replicated array `x`.
+
+  This is equivalent to `x[0]`, but returns the existing device buffer of the
+  first replica when possible, instead of dispatching a slicing op.
+
+  Args:
+    x: An array replicated along its leading dimension.
+
+  Returns:
+    The first replica of `x`.
+  """
+  if hasattr(x, 'addressable_data'):
+    buffer = x.addressable_data(0)
+  elif hasattr(x, 'device_buffers'):
+    buffer = x.device_buffers[0]
+  else:
+    buffer = None
+  # Only per-replica buffers (i.e., with the leading dimension stripped) can be
+  # returned as is.
+  if buffer is not None and buffer.shape == x.shape[1:]:
+    return buffer
+  return x[0]
+
+
 def _save_checkpoint_flax(train_state: train_states.TrainState,
                           checkpoint_dir: str, overwrite: bool,
                           unreplicate: bool, max_checkpoints: int,
-                          step: int) -> None:
-  """Saves a checkpoint using Flax serialization mechanism."""
-  if not overwrite:
-    previous_filename = latest_checkpoint(checkpoint_dir)
-    if previous_filename:
-      previous_step = int(previous_filename.rsplit('_', 1)[-1])
-      if previous_step >= step:
-        logging.warning(
-            'A more recent checkpoint `%d` has already been saved compared '
-            'to the current timestep `%d`. Skip saving a checkpoint.',
-            previous_step, step)
-        return
+                          step: int, precision: Optional[str]) -> None:
+  """Saves a checkpoint using Flax serialization mechanism.
 
-  # Assume data parallel-only model for now and retrieve train states
-  # from the first replica only.
-  def maybe_unreplicate(data):
-    if unreplicate:
-      return jax.device_get(jax_utils.unreplicate(data))
-    else:
-      return jax.device_get(data)
+  The device-to-host transfer happens synchronously, while the write to
+  `checkpoint_dir` is dispatched to a background thread. At most one save is
+  in flight at any time: a new save first waits for the previous one.
+  """
+  # Backpressure: only a single host copy of the train state may be pending.
+  _wait_for_pending_save()
+
+  if not overwrite:
+    previous_step = _LATEST_STEP_CACHE.get(checkpoint_dir)
+    # Only list `checkpoint_dir` on the first save, or if the cached step would
+    # prevent saving (e.g. `checkpoint_dir` has been modified externally).
+    if previous_step is None or previous_step >= step:
+      previous_step = None
+      previous_filename = latest_checkpoint(checkpoint_dir)
+      if previous_filename:
+        previous_step = int(previous_filename.rsplit('_', 1)[-1])
+        _LATEST_STEP_CACHE[checkpoint_dir] = previous_step
+    if previous_step is not None and previous_step >= step:
+      logging.warning(
+          'A more recent checkpoint `%d` has already been saved compared '
+          'to the current timestep `%d`. Skip saving a checkpoint.',
+          previous_step, step)
+      return
 
   # Extract/flatten data structure to store to disk. Flax requires a flattened
   # data structure to be passed to the checkpointer.
-  flattened_state, pytree_state = jax.tree_flatten(
-      maybe_unreplicate(train_state))
+  device_leaves, pytree_state = jax.tree_flatten(train_state)
+  # Assume data parallel-only model for now and retrieve train states
+  # from the first replica only.
+  if unreplicate:
+    device_leaves = [_get_first_replica(leaf) for leaf in device_leaves]
+  # Start all the device-to-host transfers, so that they overlap with each
+  # other and with the host-side work below, and only block on them at the end.
+  for leaf in device_leaves:
+    if hasattr(leaf, 'copy_to_host_async'):
+      leaf.copy_to_host_async()
   checkpoint_target = {
-      'flattened_state': flattened_state,
-      # Saves a serialized version of the pytree structure to detect potential
-      # mismatch caused by different versions of saver/restorer.
-      'str_pytree_state': str(pytree_state),
+      # Saves a signature of the pytree structure to detect potential mismatch
+      # caused by different versions of saver/restorer.
+      'pytree_hash': _treedef_signature(pytree_state),
+      'flattened_state': jax.device_get(device_leaves),
   }
-  checkpoints.save_checkpoint(
+  if precision == _BFLOAT16_PRECISION:
+    checkpoint_target['flattened_state'] = _cast_mdl_vars_to_bfloat16(
+        checkpoint_target['flattened_state'], pytree_state)
+  host_leaves = checkpoint_target['flattened_state']
+  metadata = {
+      'pytree_hash': checkpoint_target['pytree_hash'],
+      'num_leaves': len(host_leaves),
+      'shapes': [list(np.shape(x)) for x in host_leaves],
+  }
+  global _PENDING_SAVE
+  _PENDING_SAVE = _SAVE_EXECUTOR.submit(
+      _write_flax_checkpoint,
       checkpoint_dir,
       checkpoint_target,
+      metadata,
       step,
       keep=max_checkpoints,
       overwrite=overwrite)
@@ -230,23 +677,67 @@ def _restore_checkpoint_flax(
   """Restores a checkpoint using Flax serialization mechanism."""
   # Input the same data structure as in save_checkpoint().
   flattened_state, pytree_state = jax.tree_flatten(train_state)
-  str_pytree_state = str(pytree_state)
-  input_target = {
-      'flattened_state': flattened_state,
-      'str_pytree_state': str_pytree_state,
-  }
+  if step is None:
+    latest_filename = latest_checkpoint(checkpoint_dir)
+    if latest_filename:
+      step = int(latest_filename.rsplit('_', 1)[-1])
+  if step is not None:
+    _check_flax_metadata(checkpoint_dir, step, pytree_state)
+  # Restore the raw state dict so that both the current (`pytree_hash`) and the
+  # legacy (`str_pytree_state`) structure signatures can be checked.
   restored_target = checkpoints.restore_checkpoint(
-      checkpoint_dir, input_target, step=step)
-  restored_state = restored_target['flattened_state']
-  restored_str_pytree_state = restored_target['str_pytree_state']
-  if restored_str_pytree_state != str_pytree_state:
+      checkpoint_dir, None, step=step)
+  if restored_target is None:
+    # No checkpoint found, return the input train state as is.
+    return train_state
+  if 'pytree_hash' in restored_target:
+    restored_signature = restored_target['pytree_hash']
+    signature = _treedef_signature(pytree_state)
+  else:
+    restored_signature = restored_target['str_pytree_state']
+    signature = str(pytree_state)
+  if restored_signature != signature:
     raise ValueError(
         'Unable to restore checkpoint. A mismatch between the saved '
         'checkpoint structure and the current one has been detected '
-        f'(`{restored_str_pytree_state}` vs `{str_pytree_state}`).')
+        f'(`{restored_signature}` vs `{signature}`).')
+  restored_state = serialization.from_state_dict(
+      flattened_state, restored_target['flattened_state'])
+  restored_state = [
+      _cast_back_from_bfloat16(x, r)
+      for x, r in zip(flattened_state, restored_state)
+  ]
   return jax.tree_unflatten(pytree_state, restored_state)
 
 
+def _cast_back_from_bfloat16(target: Any, restored: Any) -> Any:
+  """Casts a leaf saved with the bfloat16 `precision` back to its dtype.
+
+  Args:
+    target: The leaf of the train state to restore into.
+    restored: The corresponding restored leaf.
+
+  Returns:
+    `restored`, cast to the dtype of `target` if it has been saved as bfloat16
+    from a wider floating point dtype.
+
+  Raises:
+    ValueError: If the dtypes of `restored` and `target` mismatch otherwise.
+  """
+  if not hasattr(target, 'dtype'):
+    return restored
+  restored_dtype = np.asarray(restored).dtype
+  if restored_dtype == target.dtype:
+    return restored
+  if (restored_dtype == jnp.bfloat16 and
+      jnp.issubdtype(target.dtype, jnp.floating)):
+    return np.asarray(restored).astype(target.dtype)
+  raise ValueError(
+      'Unable to restore checkpoint. A mismatch between the saved checkpoint '
+      f'dtype and the current one has been detected (`{restored_dtype}` vs '
+      f'`{target.dtype}`).')
+
+
 def _extract_nested_prefix_names(
     state: train_states.TrainState) -> train_states.TrainState:
   """Extracts prefix names from a TrainState data structure."""
@@ -275,12 +766,194 @@ def _extract_nested_prefix_names(
           right_separator=right_separator))
 
 
-def _mkdir_path(name, tmp_dir):
-  # Tensorstore does not want a trailing / in dirname.
-  path = os.path.join(tmp_dir, name).rstrip('/')
-  # Avoid recursively create parent dir.
-  tf.io.gfile.mkdir(path)
-  return path
+@functools.lru_cache(maxsize=None)
+def _flattened_nested_names(treedef: PyTreeDef) -> Tuple[str, ...]:
+  """Returns the flattened prefix names of the leaves of a TrainState treedef.
+
+  The names only depend on the pytree structure, so they are computed once per
+  structure instead of walking the full train state on every save and restore.
+
+  Args:
+    treedef: The treedef of a flattened TrainState.
+
+  Returns:
+    The prefix names, in the same order as the flattened leaves.
+  """
+  state = jax.tree_util.tree_unflatten(treedef, [0] * treedef.num_leaves)
+  flattened_names, _ = jax.tree_util.tree_flatten(
+      _extract_nested_prefix_names(state))
+  return tuple(flattened_names)
+
+
+def _snapshot_state_to_host(
+    leaves: Sequence[JTensor]) -> List[_GdaHostSnapshot]:
+  """Copies the shards of `leaves` to persist from this process to host."""
+  leaves_shards = [
+      [shard for shard in leaf.local_shards if shard.replica_id == 0]
+      for leaf in leaves
+  ]
+  # Start all the device-to-host transfers before blocking on any of them.
+  for shards in leaves_shards:
+    for shard in shards:
+      shard.data.copy_to_host_async()
+  return [
+      _GdaHostSnapshot(
+          metadata=_get_tensorstore_metadata(leaf),
+          shards=[(shard.index, np.asarray(shard.data)) for shard in shards])
+      for leaf, shards in zip(leaves, leaves_shards)
+  ]
+
+
+def _get_tensorstore_metadata(leaf: JTensor) -> Dict[str, Any]:
+  """Returns the zarr metadata of the tensorstore array storing GDA `leaf`.
+
+  This uses the same layout as `gda_serialization.async_serialize()`, with one
+  chunk per shard, so that the checkpoints can be restored with
+  `gda_serialization.async_deserialize()`.
+
+  Args:
+    leaf: A GlobalDeviceArray.
+
+  Returns:
+    The zarr metadata of the array.
+  """
+  if leaf.dtype == jnp.bfloat16:
+    # Tensorstore uses `bfloat16` rather than the numpy typestr, i.e. `<V2`.
+    dtype = 'bfloat16'
+  else:
+    dtype = np.dtype(leaf.dtype).str
+  return {
+      'compressor': {
+          'id': 'gzip'
+      },
+      'shape': list(leaf.shape),
+      'chunks': [max(1, x) for x in leaf.local_shards[0].data.shape],
+      'dtype': dtype,
+  }
+
+
+async def _flush_host_to_disk(snapshots: Sequence[_GdaHostSnapshot],
+                              tspecs: Sequence[Dict[str, Any]]) -> None:
+  """Writes the host snapshots of a train state to tensorstore."""
+
+  async def write_snapshot(snapshot, tspec):
+    t = await ts.open(
+        ts.Spec(dict(tspec, metadata=snapshot.metadata)),
+        create=True,
+        open=True,
+        context=_get_ts_context())
+    await asyncio.gather(
+        *[t[index].write(data) for index, data in snapshot.shards])
+
+  await _gather_with_concurrency_limit(
+      [write_snapshot(s, tspec) for s, tspec in zip(snapshots, tspecs)])
+
+
+def _commit_pending_gda_save() -> None:
+  """Waits for the pending GDA checkpoint writes, then commits the checkpoint.
+
+  Note that all JAX processes must call this in sync, since it barriers
+  before renaming the tmp checkpoint directory to its final location.
+  """
+  global _PENDING_GDA_SAVE, _PENDING_COMMIT_CHECK
+  if _PENDING_GDA_SAVE is None:
+    return
+  pending, _PENDING_GDA_SAVE = _PENDING_GDA_SAVE, None
+  # Any in-flight commit check is about this checkpoint.
+  _PENDING_COMMIT_CHECK = None
+  pending.future.result()
+
+  # Note we must barrier across all processes before the directory rename.
+  py_utils.sync_global_devices('Wait for checkpoint chunk writes to '
+                               f'{pending.checkpoint_step_tmp_dir} to finish.')
+
+  if jax.process_index() == 0:
+    # Rename temporary checkpoint directory to its final location.
+    logging.info('Renaming %s to %s', pending.checkpoint_step_tmp_dir,
+                 pending.checkpoint_step_dir)
+    tf.io.gfile.rename(pending.checkpoint_step_tmp_dir,
+                       pending.checkpoint_step_dir)
+    checkpoint_steps = _GDA_CHECKPOINT_STEPS.get(pending.checkpoint_dir)
+    if checkpoint_steps is None:
+      # Only list `checkpoint_dir` if no save has listed it yet.
+      checkpoint_dirnames, _ = _split_checkpoint_dirnames(
+          _listdir(pending.checkpoint_dir))
+      checkpoint_steps = sorted(
+          _get_step_from_checkpoint_dirname(x) for x in checkpoint_dirnames)
+      _GDA_CHECKPOINT_STEPS[pending.checkpoint_dir] = checkpoint_steps
+    elif pending.step not in checkpoint_steps:
+      bisect.insort(checkpoint_steps, pending.step)
+    _delete_stale_gda_checkpoints(pending.checkpoint_dir,
+                                  pending.max_checkpoints)
+  _LATEST_STEP_CACHE[pending.checkpoint_dir] = pending.step
+
+  logging.info('Finished saving GDA checkpoint for step `%s` to `%s`.',
+               pending.step, pending.checkpoint_step_dir)
+
+
+def _wait_for_pending_gda_writes() -> None:
+  """Blocks until this process has written its shards of the pending save.
+
+  This does not commit the checkpoint, which requires all the processes to
+  barrier: GDA checkpoints must be committed explicitly, e.g. by
+  `checkpoint_wait()`.
+  """
+  if _PENDING_GDA_SAVE is not None:
+    _PENDING_GDA_SAVE.future.result()
+
+
+# Only wait for the local writes at exit: barriering there would hang all the
+# processes if any of them has crashed.
+atexit.register(_wait_for_pending_gda_writes)
+
+
+def _min_over_devices_f(x):
+  return jax.lax.pmin(x, 'i')
+
+
+def _launch_all_processes_done_check(done: bool) -> JTensor:
+  """Launches a collective checking whether `done` is True on all processes.
+
+  The collective is dispatched asynchronously: only fetching its result waits
+  for it, and for the computations dispatched before it.
+  Note that all JAX processes must call this in sync, since it runs a collective
+  across all devices.
+
+  Args:
+    done: Whether the local work is done on this process.
+
+  Returns:
+    The per-local-device result of the collective: 1 if the work is done on all
+    the processes, 0 otherwise.
+  """
+  x = np.full(jax.local_device_count(), int(done), dtype=np.int32)
+  return jax.pmap(_min_over_devices_f, 'i')(x)
+
+
+def _delete_stale_gda_checkpoints(checkpoint_dir: str,
+                                  max_checkpoints: int) -> None:
+  """Deletes all but the `max_checkpoints` latest GDA checkpoints.
+
+  The committed steps are tracked in `_GDA_CHECKPOINT_STEPS`, so that
+  `checkpoint_dir` is not listed on every commit. The deletions are dispatched
+  to background threads, and are waited for by `checkpoint_wait()`.
+
+  Args:
+    checkpoint_dir: Full path to parent checkpoint_dir.
+    max_checkpoints: The number of checkpoints to keep.
+  """
+  # Drop the references to the deletions which have already completed.
+  _PENDING_DELETES[:] = [f for f in _PENDING_DELETES if not f.done()]
+  checkpoint_steps = _GDA_CHECKPOINT_STEPS[checkpoint_dir]
+  if len(checkpoint_steps) <= max_checkpoints:
+    return
+  stale_steps = checkpoint_steps[:-max_checkpoints]
+  del checkpoint_steps[:-max_checkpoints]
+  for step in stale_steps:
+    stale_dir = _make_checkpoint_step_dir(checkpoint_dir, step)
+    logging.info('Deleting stale checkpoint %s', stale_dir)
+    _PENDING_DELETES.append(
+        _DELETE_EXECUTOR.submit(tf.io.gfile.rmtree, stale_dir))
 
 
 def _save_checkpoint_gda(train_state: train_states.TrainState,
@@ -291,91 +964,98 @@ def _save_checkpoint_gda(train_state: train_states.TrainState,
   Note that all JAX processes must call _save_checkpoint_gda in sync because
   each process may only have a slice of the global data.
 
+  The save happens in two stages: the local shards are first copied to host
+  memory, then written to `checkpoint_dir` in the background. The checkpoint is
+  committed by `maybe_commit_checkpoint()` shortly after all processes have
+  written it, or at the latest by the next `save_checkpoint()`,
+  `restore_checkpoint()` or `checkpoint_wait()` call.
+
   Args:
     train_state: A partitioned train_state that is a Pytree of
       GlobalDeviceArray.
     checkpoint_dir: Full path to parent checkpoint_dir.
     overwrite: Whether to allow overwriting an existing target directory.
-    max_checkpoints: Unsupported.
+    max_checkpoints: The number of past checkpoints to keep.
     step: Step to save checkpoint for.
   """
-  # TODO(zhangqiaorjc): Support max_checkpoints.
-  del max_checkpoints
+  # Backpressure: commit the previous checkpoint before snapshotting a new one,
+  # so that at most one host copy of the train state is alive at any time.
+  _commit_pending_gda_save()
+  if overwrite:
+    # The step to save may be a stale checkpoint still being deleted.
+    _wait_for_pending_deletes()
 
   if not overwrite:
-    # Does not contain directory path, only dirname is returned.
-    checkpoint_dirnames = tf.io.gfile.listdir(checkpoint_dir)
-    # Delete tmp directories if any.
-    if jax.process_index() == 0:
-      tmp_checkpoint_dirnames = [
-          x for x in checkpoint_dirnames if _is_tmp_checkpoint_dir(x)
-      ]
-      if tmp_checkpoint_dirnames:
-        logging.warn('Found incompletely saved checkpoints %s; deleting them',
-                     tmp_checkpoint_dirnames)
-        for x in tmp_checkpoint_dirnames:
-          tf.io.gfile.rmtree(os.path.join(checkpoint_dir, x))
-    # Note we must barrier across all processes after the tmp directory delete.
-    py_utils.sync_global_devices('Wait for checkpoint tmp dir deletions to '
-                                 'finish.')
-
-    sorted_dirnames = sorted([
-        x for x in checkpoint_dirnames
-        if _is_checkpoint_dir(x) and not _is_tmp_checkpoint_dir(x)
-    ])
-    if sorted_dirnames:
-      latest_checkpoint_dirname = sorted_dirnames[-1]
-      previous_step = _get_step_from_checkpoint_dirname(
-          latest_checkpoint_dirname)
-      if previous_step >= step:
-        logging.warning(
-            'A more recent checkpoint `%d` has already been saved compared '
-            'to the current timestep `%d`. Skip saving a checkpoint.',
-            previous_step, step)
-        return
+    previous_step = _LATEST_STEP_CACHE.get(checkpoint_dir)
+    # Only list `checkpoint_dir` on the first save, or if the cached step would
+    # prevent saving (e.g. `checkpoint_dir` has been modified externally).
+    if previous_step is None or previous_step >= step:
+      previous_step = None
+      # Does not contain directory path, only dirname is returned.
+      checkpoint_dirnames, tmp_checkpoint_dirnames = (
+          _split_checkpoint_dirnames(_listdir(checkpoint_dir)))
+      # Delete tmp directories if any.
+      if jax.process_index() == 0:
+        if tmp_checkpoint_dirnames:
+          logging.warn('Found incompletely saved checkpoints %s; deleting them',
+                       tmp_checkpoint_dirnames)
+          for x in tmp_checkpoint_dirnames:
+            tf.io.gfile.rmtree(os.path.join(checkpoint_dir, x))
+      # Note we must barrier across all processes after the tmp directory
+      # delete.
+      py_utils.sync_global_devices('Wait for checkpoint tmp dir deletions to '
+                                   'finish.')
+
+      checkpoint_steps = sorted(
+          _get_step_from_checkpoint_dirname(x) for x in checkpoint_dirnames)
+      _GDA_CHECKPOINT_STEPS[checkpoint_dir] = checkpoint_steps
+      previous_step = checkpoint_steps[-1] if checkpoint_steps else None
+      if previous_step is not None:
+        _LATEST_STEP_CACHE[checkpoint_dir] = previous_step
+    if previous_step is not None and previous_step >= step:
+      logging.warning(
+          'A more recent checkpoint `%d` has already been saved compared '
+          'to the current timestep `%d`. Skip saving a checkpoint.',
+          previous_step, step)
+      return
 
   checkpoint_step_dir = _make_checkpoint_step_dir(checkpoint_dir, step)
   checkpoint_step_tmp_dir = _make_tmp_checkpoint_dir(checkpoint_dir, step)
+
+  leaves, treedef = jax.tree_util.tree_flatten(train_state)
+  flattened_nested_names = _flattened_nested_names(treedef)
+  # Tensorstore does not want a trailing / in dirname.
+  ckpt_paths = [
+      os.path.join(checkpoint_step_tmp_dir, x).rstrip('/')
+      for x in flattened_nested_names
+  ]
+
   if jax.process_index() == 0:
-    # Create the tmp parent dir.
-    tf.io.gfile.makedirs(checkpoint_step_tmp_dir)
+    # Create the tmp parent dir and any intermediate dir of the leaves. The
+    # leaf dirs themselves are created by tensorstore when writing, so this
+    # only takes as many calls as there are distinct parent dirs.
+    for parent_dir in sorted({os.path.dirname(x) for x in ckpt_paths} |
+                             {checkpoint_step_tmp_dir}):
+      tf.io.gfile.makedirs(parent_dir)
   # Note we must barrier across all processes after the directory creation.
   py_utils.sync_global_devices('Wait for checkpoint tmp dir creation '
                                f'{checkpoint_step_tmp_dir} to finish.')
 
   logging.info('Saving to a tmp checkpoint dir %s', checkpoint_step_tmp_dir)
 
-  nested_names = _extract_nested_prefix_names(train_state)
-  flattened_nested_names, _ = jax.tree_util.tree_flatten(nested_names)
-
-  with futures.ThreadPoolExecutor() as executor:
-    ckpt_paths = list(
-        executor.map(_mkdir_path, flattened_nested_names,
-                     [checkpoint_step_tmp_dir] * len(flattened_nested_names)))
-
-  tspecs = jax.tree_map(gda_serialization.get_tensorstore_spec, ckpt_paths)
+  tspecs = [gda_serialization.get_tensorstore_spec(x) for x in ckpt_paths]
 
-  leaves, _ = jax.tree_util.tree_flatten(train_state)
-
-  async def run_serializer():
-    future_writer = jax.tree_map(gda_serialization.async_serialize, ckpt_paths,
-                                 leaves, tspecs)
-    return await asyncio.gather(*future_writer)
-
-  asyncio.run(run_serializer())
-
-  # Note we must barrier across all processes before the directory rename.
-  py_utils.sync_global_devices('Wait for checkpoint chunk writes to '
-                               f'{checkpoint_step_tmp_dir} to finish.')
-
-  if jax.process_index() == 0:
-    # Rename temporary checkpoint directory to its final location.
-    logging.info('Renaming %s to %s', checkpoint_step_tmp_dir,
-                 checkpoint_step_dir)
-    tf.io.gfile.rename(checkpoint_step_tmp_dir, checkpoint_step_dir)
-
-  logging.info('Finished saving GDA checkpoint for step `%s` to `%s`.', step,
-               checkpoint_step_dir)
+  # Only block on the device-to-host copy: the train state may be donated and
+  # overwritten by the next training step as soon as this returns.
+  snapshots = _snapshot_state_to_host(leaves)
+  global _PENDING_GDA_SAVE
+  _PENDING_GDA_SAVE = _PendingGdaSave(
+      future=_submit_coroutine(_flush_host_to_disk(snapshots, tspecs)),
+      checkpoint_dir=checkpoint_dir,
+      checkpoint_step_tmp_dir=checkpoint_step_tmp_dir,
+      checkpoint_step_dir=checkpoint_step_dir,
+      step=step,
+      max_checkpoints=max_checkpoints)
 
 
 def _restore_checkpoint_gda(
@@ -385,36 +1065,29 @@ def _restore_checkpoint_gda(
     mesh_axes: Optional[train_states.TrainState],
     step: Optional[int] = None) -> train_states.TrainState:
   """Restores a checkpoint using JAX GDA deserialization mechanism."""
-  if not tf.io.gfile.exists(checkpoint_dir) or not tf.io.gfile.listdir(
-      checkpoint_dir):
+  if not tf.io.gfile.exists(checkpoint_dir) or not _listdir(checkpoint_dir):
     logging.info(
         'GDA checkpoint restore did not find checkpoint_dir %s; '
         'Return train_state passed in', checkpoint_dir)
     return train_state
 
   if step is None:
-    checkpoint_dirnames = tf.io.gfile.listdir(checkpoint_dir)
-    tmp_checkpoint_dirnames = [
-        x for x in checkpoint_dirnames if _is_tmp_checkpoint_dir(x)
-    ]
+    checkpoint_dirnames, tmp_checkpoint_dirnames = _split_checkpoint_dirnames(
+        _listdir(checkpoint_dir))
     if tmp_checkpoint_dirnames:
       logging.warn('Found incompletely saved checkpoints %s; skipping them',
                    tmp_checkpoint_dirnames)
-    sorted_dirnames = sorted([
-        x for x in checkpoint_dirnames
-        if _is_checkpoint_dir(x) and not _is_tmp_checkpoint_dir(x)
-    ])
-    if not sorted_dirnames:
+    if not checkpoint_dirnames:
       raise FileNotFoundError(
           f'No checkpoint found for restore in {checkpoint_dir}')
-    latest_checkpoint_dirname = sorted_dirnames[-1]
-    step = _get_step_from_checkpoint_dirname(latest_checkpoint_dirname)
+    step = max(
+        _get_step_from_checkpoint_dirname(x) for x in checkpoint_dirnames)
     checkpoint_step_dir = _make_checkpoint_step_dir(checkpoint_dir, step)
     logging.info('Found latest checkpoint: %s', checkpoint_step_dir)
   else:
     checkpoint_step_dir = _make_checkpoint_step_dir(checkpoint_dir, step)
-    if not tf.io.gfile.exists(checkpoint_step_dir) or not tf.io.gfile.listdir(
-        checkpoint_step_dir):
+    if (not tf.io.gfile.exists(checkpoint_step_dir) or
+        not _listdir(checkpoint_step_dir)):
       raise FileNotFoundError(
           f'No checkpoint found for restore in {checkpoint_step_dir}')
 
@@ -422,23 +1095,21 @@ def _restore_checkpoint_gda(
   leaves, treedef = jax.tree_util.tree_flatten(train_state)
   partition_spec_leaves, _ = jax.tree_util.tree_flatten(mesh_axes)
 
-  nested_names = _extract_nested_prefix_names(train_state)
-  flattened_nested_names, _ = jax.tree_util.tree_flatten(nested_names)
-
-  ckpt_paths = [
-      os.path.join(checkpoint_step_dir, x).rstrip('/')
-      for x in flattened_nested_names
-  ]
+  flattened_nested_names = _flattened_nested_names(treedef)
 
   async def run_deserializer():
-    tspecs = jax.tree_map(gda_serialization.get_tensorstore_spec,
-                          ckpt_paths)
-    future_gdas = jax.tree_map(gda_serialization.async_deserialize, ckpt_paths,
-                               [global_mesh] * len(leaves),
-                               partition_spec_leaves, tspecs)
-    return await asyncio.gather(*future_gdas)
-
-  train_state_gda = asyncio.run(run_deserializer())
+    future_gdas = []
+    # Build the path, the spec and the coroutine of each leaf in a single pass.
+    for name, partition_spec in zip(flattened_nested_names,
+                                    partition_spec_leaves):
+      ckpt_path = os.path.join(checkpoint_step_dir, name).rstrip('/')
+      future_gdas.append(
+          gda_serialization.async_deserialize(
+              ckpt_path, global_mesh, partition_spec,
+              gda_serialization.get_tensorstore_spec(ckpt_path)))
+    return await _gather_with_concurrency_limit(future_gdas)
+
+  train_state_gda = _run_coroutine(run_deserializer())
   restored_train_state = jax.tree_util.tree_unflatten(treedef, train_state_gda)
   # Barrier across all processes to ensure all restore finish.
   py_utils.sync_global_devices('Wait for checkpoint restore from '
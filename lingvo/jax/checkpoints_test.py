@@ -0,0 +1,308 @@
+# Lint as: python3
+# Copyright 2021 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for checkpoints."""
+
+import os
+
+from absl.testing import absltest
+from flax.training import checkpoints as flax_checkpoints
+import jax
+from jax import test_util
+from jax.experimental import global_device_array as gda_lib
+from jax.experimental import maps
+from jax.experimental import pjit
+import jax.numpy as jnp
+from lingvo.jax import checkpoints
+from lingvo.jax import py_utils
+from lingvo.jax import train_states
+import numpy as np
+import tensorflow.compat.v2 as tf
+
+
+def _make_train_state(step, seed=1234):
+  np.random.seed(seed)
+  return train_states.TrainState(
+      step=jnp.array(step, dtype=jnp.int32),
+      mdl_vars=py_utils.NestedMap(
+          w=jnp.asarray(np.random.normal(size=[4, 3]), dtype=jnp.float32),
+          b=jnp.arange(3, dtype=jnp.int32)),
+      opt_states=[
+          py_utils.NestedMap(
+              m=jnp.asarray(np.random.normal(size=[4, 3]), dtype=jnp.float32))
+      ])
+
+
+def _to_replicated_gdas(train_state, global_mesh):
+  return jax.tree_map(
+      lambda x: gda_lib.GlobalDeviceArray.from_callback(
+          x.shape, global_mesh, pjit.PartitionSpec(),
+          lambda index, x=np.asarray(x): x[index]), train_state)
+
+
+class CheckpointsTest(test_util.JaxTestCase):
+
+  def test_split_checkpoint_dirnames(self):
+    final_dirnames, tmp_dirnames = checkpoints._split_checkpoint_dirnames([
+        'checkpoint_00000010',
+        'checkpoint_00000020.tmp_1234',
+        'checkpoint_00000030',
+        'checkpoint_',
+        'checkpoint_00000040.tmp_',
+        'checkpoint_00000050.tmp',
+        'checkpoint_0000006a',
+        'metadata_10.json',
+        'summaries',
+    ])
+    self.assertEqual(['checkpoint_00000010', 'checkpoint_00000030'],
+                     final_dirnames)
+    self.assertEqual(['checkpoint_00000020.tmp_1234'], tmp_dirnames)
+
+  def test_save_and_restore(self):
+    checkpoint_dir = self.create_tempdir().full_path
+    train_state = _make_train_state(step=10)
+    checkpoints.save_checkpoint(
+        train_state, checkpoint_dir, unreplicate=False)
+    # The asynchronous write must be completed by the restore.
+    restored_state = checkpoints.restore_checkpoint(
+        _make_train_state(step=0, seed=4321),
+        checkpoint_dir,
+        global_mesh=None,
+        mesh_axes=None)
+    for x, y in zip(
+        jax.tree_leaves(train_state), jax.tree_leaves(restored_state)):
+      self.assertEqual(x.dtype, y.dtype)
+      self.assertArraysEqual(np.asarray(x), np.asarray(y))
+
+  def test_save_and_restore_bfloat16(self):
+    checkpoint_dir = self.create_tempdir().full_path
+    train_state = _make_train_state(step=10)
+    checkpoints.save_checkpoint(
+        train_state, checkpoint_dir, unreplicate=False, precision='bfloat16')
+    checkpoints.checkpoint_wait()
+    # Only the floating point model variables are stored as bfloat16.
+    raw_state = flax_checkpoints.restore_checkpoint(checkpoint_dir, None)
+    # The flattened leaves are step, mdl_vars.b, mdl_vars.w and opt_states.m.
+    raw_dtypes = [
+        np.asarray(raw_state['flattened_state'][str(i)]).dtype
+        for i in range(4)
+    ]
+    self.assertEqual([np.int32, np.int32, jnp.bfloat16, np.float32],
+                     raw_dtypes)
+
+    restored_state = checkpoints.restore_checkpoint(
+        _make_train_state(step=0, seed=4321),
+        checkpoint_dir,
+        global_mesh=None,
+        mesh_axes=None)
+    self.assertEqual(jnp.float32, restored_state.mdl_vars.w.dtype)
+    self.assertArraysEqual(
+        np.asarray(train_state.mdl_vars.w.astype(jnp.bfloat16), np.float32),
+        np.asarray(restored_state.mdl_vars.w))
+    self.assertArraysEqual(
+        np.asarray(train_state.opt_states[0].m),
+        np.asarray(restored_state.opt_states[0].m))
+
+    # Restoring into bfloat16 variables keeps them as is.
+    train_state_bf16 = _make_train_state(step=0, seed=4321)
+    train_state_bf16 = train_state_bf16.replace(
+        mdl_vars=py_utils.NestedMap(
+            w=train_state_bf16.mdl_vars.w.astype(jnp.bfloat16),
+            b=train_state_bf16.mdl_vars.b))
+    restored_state = checkpoints.restore_checkpoint(
+        train_state_bf16, checkpoint_dir, global_mesh=None, mesh_axes=None)
+    self.assertEqual(jnp.bfloat16, restored_state.mdl_vars.w.dtype)
+    self.assertArraysEqual(
+        np.asarray(train_state.mdl_vars.w.astype(jnp.bfloat16), np.float32),
+        np.asarray(restored_state.mdl_vars.w, np.float32))
+
+  def test_save_invalid_precision(self):
+    with self.assertRaises(ValueError):
+      checkpoints.save_checkpoint(
+          _make_train_state(step=10),
+          self.create_tempdir().full_path,
+          unreplicate=False,
+          precision='int8')
+
+  def test_restore_legacy_str_pytree_state(self):
+    checkpoint_dir = self.create_tempdir().full_path
+    train_state = _make_train_state(step=10)
+    leaves, treedef = jax.tree_flatten(train_state)
+    # Checkpoints saved before the pytree hash and without metadata file.
+    flax_checkpoints.save_checkpoint(
+        checkpoint_dir, {
+            'str_pytree_state': str(treedef),
+            'flattened_state': jax.device_get(leaves),
+        },
+        step=10)
+    restored_state = checkpoints.restore_checkpoint(
+        _make_train_state(step=0, seed=4321),
+        checkpoint_dir,
+        global_mesh=None,
+        mesh_axes=None)
+    for x, y in zip(
+        jax.tree_leaves(train_state), jax.tree_leaves(restored_state)):
+      self.assertArraysEqual(np.asarray(x), np.asarray(y))
+
+  def test_restore_mismatched_structure(self):
+    checkpoint_dir = self.create_tempdir().full_path
+    checkpoints.save_checkpoint(
+        _make_train_state(step=10), checkpoint_dir, unreplicate=False)
+    train_state = _make_train_state(step=0)
+    train_state = train_state.replace(
+        mdl_vars=py_utils.NestedMap(w=train_state.mdl_vars.w))
+    with self.assertRaises(ValueError):
+      checkpoints.restore_checkpoint(
+          train_state, checkpoint_dir, global_mesh=None, mesh_axes=None)
+
+  def test_restore_mismatched_dtype(self):
+    checkpoint_dir = self.create_tempdir().full_path
+    checkpoints.save_checkpoint(
+        _make_train_state(step=10), checkpoint_dir, unreplicate=False)
+    train_state = _make_train_state(step=0)
+    # Only variables saved as bfloat16 are cast back on restore.
+    train_state = train_state.replace(
+        step=train_state.step.astype(jnp.float32))
+    with self.assertRaises(ValueError):
+      checkpoints.restore_checkpoint(
+          train_state, checkpoint_dir, global_mesh=None, mesh_axes=None)
+
+  def test_metadata_retention(self):
+    checkpoint_dir = self.create_tempdir().full_path
+    # Metadata file left by a previous job, for a checkpoint to be deleted.
+    with tf.io.gfile.GFile(os.path.join(checkpoint_dir, 'metadata_1.json'),
+                           'w') as f:
+      f.write('{}')
+    for step in range(2, 6):
+      checkpoints.save_checkpoint(
+          _make_train_state(step=step),
+          checkpoint_dir,
+          unreplicate=False,
+          max_checkpoints=2)
+    checkpoints.checkpoint_wait()
+    self.assertEqual([
+        'checkpoint_4', 'checkpoint_5', 'metadata_4.json', 'metadata_5.json'
+    ], sorted(tf.io.gfile.listdir(checkpoint_dir)))
+
+  def test_latest_step_cache(self):
+    checkpoint_dir = self.create_tempdir().full_path
+    checkpoints.save_checkpoint(
+        _make_train_state(step=10), checkpoint_dir, unreplicate=False)
+    checkpoints.checkpoint_wait()
+    self.assertEqual(10, checkpoints._LATEST_STEP_CACHE[checkpoint_dir])
+
+    # Saving an older step is skipped.
+    checkpoints.save_checkpoint(
+        _make_train_state(step=5), checkpoint_dir, unreplicate=False)
+    checkpoints.checkpoint_wait()
+    self.assertEqual(
+        os.path.join(checkpoint_dir, 'checkpoint_10'),
+        checkpoints.latest_checkpoint(checkpoint_dir))
+
+    # The cached step is refreshed once `checkpoint_dir` has been modified
+    # externally, so that the older step can now be saved.
+    tf.io.gfile.rmtree(checkpoint_dir)
+    checkpoints.save_checkpoint(
+        _make_train_state(step=5), checkpoint_dir, unreplicate=False)
+    checkpoints.checkpoint_wait()
+    self.assertEqual(5, checkpoints._LATEST_STEP_CACHE[checkpoint_dir])
+    self.assertEqual(
+        os.path.join(checkpoint_dir, 'checkpoint_5'),
+        checkpoints.latest_checkpoint(checkpoint_dir))
+
+  def _enable_gda_outputs(self):
+    jax.config.update('jax_parallel_functions_output_gda', True)
+    self.addCleanup(jax.config.update, 'jax_parallel_functions_output_gda',
+                    False)
+
+  def test_save_and_restore_gda(self):
+    self._enable_gda_outputs()
+    checkpoint_dir = self.create_tempdir().full_path
+    global_mesh = maps.Mesh(np.array(jax.devices()), ('x',))
+    train_state = _to_replicated_gdas(_make_train_state(step=10), global_mesh)
+    mesh_axes = jax.tree_map(lambda _: pjit.PartitionSpec(), train_state)
+    checkpoints.save_checkpoint(train_state, checkpoint_dir, unreplicate=False)
+    # The pending checkpoint must be committed by the restore of its step,
+    # without calling checkpoint_wait() first.
+    restored_state = checkpoints.restore_checkpoint(
+        _to_replicated_gdas(_make_train_state(step=0, seed=4321), global_mesh),
+        checkpoint_dir,
+        global_mesh=global_mesh,
+        mesh_axes=mesh_axes,
+        step=10)
+    for x, y in zip(
+        jax.tree_leaves(train_state), jax.tree_leaves(restored_state)):
+      self.assertEqual(x.dtype, y.dtype)
+      self.assertArraysEqual(
+          np.asarray(x.local_data(0)), np.asarray(y.local_data(0)))
+
+  def test_save_and_restore_gda_dtypes(self):
+    self._enable_gda_outputs()
+    checkpoint_dir = self.create_tempdir().full_path
+    global_mesh = maps.Mesh(np.array(jax.devices()), ('x',))
+    # Leaves whose tensorstore metadata is special cased on save: bfloat16 has
+    # no numpy dtype string, and zero-sized dimensions still need chunks >= 1.
+    train_state = _make_train_state(step=10)
+    train_state = train_state.replace(
+        mdl_vars=py_utils.NestedMap(
+            w=train_state.mdl_vars.w.astype(jnp.bfloat16),
+            b=jnp.zeros([0, 3], dtype=jnp.float32)))
+    train_state = _to_replicated_gdas(train_state, global_mesh)
+    mesh_axes = jax.tree_map(lambda _: pjit.PartitionSpec(), train_state)
+    checkpoints.save_checkpoint(train_state, checkpoint_dir, unreplicate=False)
+    checkpoints.checkpoint_wait()
+    target_state = _make_train_state(step=0, seed=4321)
+    target_state = target_state.replace(
+        mdl_vars=py_utils.NestedMap(
+            w=target_state.mdl_vars.w.astype(jnp.bfloat16),
+            b=jnp.ones([0, 3], dtype=jnp.float32)))
+    restored_state = checkpoints.restore_checkpoint(
+        _to_replicated_gdas(target_state, global_mesh),
+        checkpoint_dir,
+        global_mesh=global_mesh,
+        mesh_axes=mesh_axes)
+    self.assertEqual(jnp.bfloat16, restored_state.mdl_vars.w.dtype)
+    self.assertEqual((0, 3), restored_state.mdl_vars.b.shape)
+    for x, y in zip(
+        jax.tree_leaves(train_state), jax.tree_leaves(restored_state)):
+      self.assertEqual(x.dtype, y.dtype)
+      self.assertArraysEqual(
+          np.asarray(x.local_data(0), np.float32),
+          np.asarray(y.local_data(0), np.float32))
+
+  def test_maybe_commit_checkpoint(self):
+    self._enable_gda_outputs()
+    checkpoint_dir = self.create_tempdir().full_path
+    global_mesh = maps.Mesh(np.array(jax.devices()), ('x',))
+    for step in range(1, 4):
+      checkpoints.save_checkpoint(
+          _to_replicated_gdas(_make_train_state(step=step), global_mesh),
+          checkpoint_dir,
+          unreplicate=False,
+          max_checkpoints=2)
+      # Wait for the background writes only; the commit happens right after.
+      checkpoints._PENDING_GDA_SAVE.future.result()
+      checkpoints.maybe_commit_checkpoint()
+      self.assertIsNone(checkpoints._PENDING_GDA_SAVE)
+      self.assertTrue(
+          tf.io.gfile.exists(
+              os.path.join(checkpoint_dir, f'checkpoint_{step:08}')))
+    checkpoints.checkpoint_wait()
+    self.assertEqual(['checkpoint_00000002', 'checkpoint_00000003'],
+                     sorted(tf.io.gfile.listdir(checkpoint_dir)))
+
+
+if __name__ == '__main__':
+  absltest.main()
@@ -15,17 +15,21 @@
 # ==============================================================================
 """Evaluation loop for lingvo Jax model."""
 
+from concurrent import futures
 import contextlib
 import functools
 import hashlib
 import os
+import queue
+import threading
 import time
-from typing import Optional, Sequence
+from typing import Any, Callable, Iterator, Optional, Sequence, Tuple
 
 from absl import logging
 import jax
 from jax.experimental import maps
 from jax.experimental import mesh_utils
+from jax.experimental import multihost_utils
 from lingvo.jax import base_layer
 from lingvo.jax import base_model_params
 from lingvo.jax import model_utils
@@ -34,6 +38,7 @@ from lingvo.jax import pytypes
 from lingvo.jax import summary_utils
 from lingvo.jax import train_states
 from lingvo.jax import trainer_lib
+import numpy as np
 import tensorflow.compat.v2 as tf
 
 from lingvo.jax import checkpoints
@@ -47,6 +52,192 @@ NestedJTensor = pytypes.NestedJTensor
 TrainState = train_states.TrainState
 SummaryWriter = tf.summary.SummaryWriter
 
+# Bounds (in seconds) of the exponential backoff used to poll for new
+# checkpoints.
+_MIN_CHECKPOINT_POLL_SECS = 1.
+_MAX_CHECKPOINT_POLL_SECS = 60.
+# Maximum length in bytes of a checkpoint path broadcast across processes.
+_MAX_CHECKPOINT_PATH_LEN = 4096
+
+
+def _broadcast_checkpoint_path(path: Optional[str]) -> Optional[str]:
+  """Broadcasts the checkpoint `path` of process 0 to all the processes."""
+  encoded = (path or '').encode()
+  if len(encoded) > _MAX_CHECKPOINT_PATH_LEN:
+    raise ValueError(f'Checkpoint path `{path}` is too long to be broadcast.')
+  buffer = np.zeros(_MAX_CHECKPOINT_PATH_LEN + 1, dtype=np.uint8)
+  buffer[0] = len(encoded) > 0
+  buffer[1:len(encoded) + 1] = np.frombuffer(encoded, dtype=np.uint8)
+  buffer = np.asarray(multihost_utils.broadcast_one_to_all(buffer))
+  if not buffer[0]:
+    return None
+  return buffer[1:].tobytes().rstrip(b'\0').decode()
+
+
+def _wait_for_new_checkpoint(
+    checkpoint_dir: str,
+    last_checkpoint: Optional[str],
+    stop_event: Optional[threading.Event] = None) -> Optional[str]:
+  """Waits for a checkpoint newer than `last_checkpoint` to be available.
+
+  Only process 0 lists `checkpoint_dir`, and broadcasts the latest checkpoint
+  path to the other processes. All the processes then run the same
+  exponential backoff schedule between two polls, so that the broadcast
+  collective never blocks for longer than a single listing.
+  Note that all JAX processes must call this in sync.
+
+  Args:
+    checkpoint_dir: The base directory from where to retrieve checkpoints.
+    last_checkpoint: The path to the last evaluated checkpoint, if any.
+    stop_event: If set, waiting stops early once this event is set, in which
+      case `last_checkpoint` is returned. This is only supported in
+      single-process jobs, where no process can be left in the broadcast.
+
+  Returns:
+    The path to the new checkpoint.
+  """
+  if stop_event is not None and jax.process_count() > 1:
+    raise ValueError('`stop_event` is only supported in single-process jobs.')
+  poll_secs = _MIN_CHECKPOINT_POLL_SECS
+  while True:
+    new_checkpoint = None
+    if jax.process_index() == 0:
+      new_checkpoint = checkpoints.latest_checkpoint(checkpoint_dir)
+    if jax.process_count() > 1:
+      new_checkpoint = _broadcast_checkpoint_path(new_checkpoint)
+    if new_checkpoint != last_checkpoint:
+      return new_checkpoint
+    if stop_event is None:
+      time.sleep(poll_secs)
+    elif stop_event.wait(poll_secs):
+      return last_checkpoint
+    poll_secs = min(_MAX_CHECKPOINT_POLL_SECS, poll_secs * 1.5)
+
+
+def _get_checkpoint_step(checkpoint: str) -> int:
+  """Returns the step of the checkpoint at path `checkpoint`."""
+  return int(checkpoint.split('_')[-1])
+
+
+def _restore_pmap_model_states(model_states: TrainState, checkpoint_dir: str,
+                               checkpoint_type: checkpoints.CheckpointType,
+                               checkpoint: Optional[str]) -> TrainState:
+  """Restores the unreplicated pmap model states from `checkpoint`.
+
+  Args:
+    model_states: The unreplicated TrainState (or its restore template) to
+      restore into.
+    checkpoint_dir: The base directory from where to retrieve checkpoints.
+    checkpoint_type: Type of model checkpointing method to use.
+    checkpoint: The path to the checkpoint to restore, or None if there is no
+      checkpoint, in which case `model_states` is returned as is.
+
+  Returns:
+    The restored unreplicated TrainState.
+  """
+  # Pmap does not use GDA, and so global_mesh and mesh_axes are None.
+  return checkpoints.restore_checkpoint(
+      model_states,
+      checkpoint_dir,
+      global_mesh=None,
+      mesh_axes=None,
+      checkpoint_type=checkpoint_type,
+      step=_get_checkpoint_step(checkpoint) if checkpoint else None)
+
+
+class _CheckpointPrefetcher:
+  """Restores new Flax checkpoints to host memory in a background thread.
+
+  This hides the checkpoint restore latency behind the evaluation of the
+  previous checkpoint. At most one restored train state is buffered at a time.
+  The background thread runs until stop() is called.
+  """
+
+  def __init__(self, model_states: TrainState, checkpoint_dir: str,
+               checkpoint_type: checkpoints.CheckpointType,
+               last_checkpoint: Optional[str]) -> None:
+    """Constructor.
+
+    Args:
+      model_states: The unreplicated TrainState to restore checkpoints into.
+      checkpoint_dir: The base directory from where to retrieve checkpoints.
+      checkpoint_type: Type of model checkpointing method to use.
+      last_checkpoint: The path to the last restored checkpoint, if any.
+    """
+    self._model_states = model_states
+    self._checkpoint_dir = checkpoint_dir
+    self._checkpoint_type = checkpoint_type
+    self._last_checkpoint = last_checkpoint
+    self._queue = queue.Queue(maxsize=1)
+    self._stop_event = threading.Event()
+    self._thread = threading.Thread(
+        target=self._run, name='checkpoint_prefetcher', daemon=True)
+    self._thread.start()
+
+  def _put(self, item: Tuple[Optional[str], Optional[TrainState],
+                             Optional[Exception]]) -> None:
+    """Puts `item` in the queue, unless the prefetcher is stopped first."""
+    while not self._stop_event.is_set():
+      try:
+        self._queue.put(item, timeout=_MIN_CHECKPOINT_POLL_SECS)
+        return
+      except queue.Full:
+        pass
+
+  def _run(self) -> None:
+    try:
+      while not self._stop_event.is_set():
+        new_checkpoint = _wait_for_new_checkpoint(self._checkpoint_dir,
+                                                  self._last_checkpoint,
+                                                  self._stop_event)
+        if self._stop_event.is_set():
+          return
+        # Restore the step that was found, even if a newer checkpoint has been
+        # saved in the meantime. There is nothing to restore if the
+        # checkpoints have been removed.
+        model_states = None
+        if new_checkpoint is not None:
+          model_states = _restore_pmap_model_states(self._model_states,
+                                                    self._checkpoint_dir,
+                                                    self._checkpoint_type,
+                                                    new_checkpoint)
+        self._put((new_checkpoint, model_states, None))
+        self._last_checkpoint = new_checkpoint
+    except Exception as e:  # pylint: disable=broad-except
+      self._put((None, None, e))
+
+  def get(self) -> Tuple[Optional[str], Optional[TrainState]]:
+    """Returns the path to and the restored state of the next checkpoint.
+
+    Both are None if there is no checkpoint anymore.
+    """
+    new_checkpoint, model_states, error = self._queue.get()
+    if error is not None:
+      raise error
+    return new_checkpoint, model_states
+
+  def stop(self) -> None:
+    """Stops and joins the background thread."""
+    self._stop_event.set()
+    self._thread.join()
+
+
+def _get_restore_template(model_states: TrainState) -> TrainState:
+  """Returns the shapes and dtypes of `model_states`, to restore Flax states.
+
+  Flax checkpoints only need the structure, shapes and dtypes of their target.
+  Restoring into this template rather than into a previously restored state
+  lets the host copy of that state be released once it has been replicated.
+
+  Args:
+    model_states: An unreplicated TrainState.
+
+  Returns:
+    A TrainState of jax.ShapeDtypeStruct.
+  """
+  return jax.tree_map(lambda x: jax.ShapeDtypeStruct(x.shape, x.dtype),
+                      model_states)
+
 
 def evaluate(
     model_name: str,
@@ -98,14 +289,15 @@ def evaluate_pmap_model(
 
   checkpoint_dir = os.path.join(job_log_dir, 'checkpoints')
   model_states = trainer_lib.initialize_model_state(jax_model, init_key)
-  # Pmap does not use GDA, and so global_mesh and mesh_axes are None.
-  model_states = checkpoints.restore_checkpoint(
-      model_states,
-      checkpoint_dir,
-      global_mesh=None,
-      mesh_axes=None,
-      checkpoint_type=checkpoint_type)
+  # Look up the latest checkpoint once, and restore that exact step.
+  last_checkpoint = checkpoints.latest_checkpoint(checkpoint_dir)
+  model_states = _restore_pmap_model_states(model_states, checkpoint_dir,
+                                            checkpoint_type, last_checkpoint)
+  # Read the global step from the unreplicated state, to not have to fetch it
+  # back from the devices.
+  step_i = int(model_states.step)
   replicated_model_states = trainer_lib.replicate_model_state(model_states)
+  model_states = _get_restore_template(model_states)
   logging.info('replicated_model_states: %s',
                jax.tree_map(lambda x: x.shape, replicated_model_states))
   # From now on, different replicas should use different random seeds.
@@ -141,15 +333,20 @@ def evaluate_pmap_model(
   num_steps = [
       -1 if p.reset_for_eval else p.eval_loop_num_batches for p in eval_input_p
   ]
-  last_checkpoint = checkpoints.latest_checkpoint(checkpoint_dir)
   with contextlib.ExitStack() as exit_stack:
     eval_summary_writers = [
         exit_stack.enter_context(summary_utils.get_summary_writer(d))
         for d in summary_eval_dirs
     ]
+    # Checkpoint discovery relies on a collective across processes in
+    # multi-host jobs, so it can only run in the main thread there.
+    prefetcher = None
+    if jax.process_count() == 1:
+      prefetcher = _CheckpointPrefetcher(model_states, checkpoint_dir,
+                                         checkpoint_type, last_checkpoint)
+      exit_stack.callback(prefetcher.stop)
 
     while True:
-      step_i = int(jax.device_get(replicated_model_states.step)[0])
       eval_step = functools.partial(p_eval_step,
                                     replicated_model_states.mdl_vars,
                                     eval_prng_seed,
@@ -164,26 +361,30 @@ def evaluate_pmap_model(
           reshard_inputs=True)
       # If the last check point evaluated matches max train steps, exit.
       if last_checkpoint is not None:
-        last_ckpt_step = int(last_checkpoint.split('_')[-1])
+        last_ckpt_step = _get_checkpoint_step(last_checkpoint)
         exceeded_ckpt = last_ckpt_step + model_p.train.save_interval_steps
         if exceeded_ckpt >= model_p.train.num_train_steps:
           break
+      if prefetcher is not None:
+        new_checkpoint, model_states = prefetcher.get()
+      else:
+        new_checkpoint = _wait_for_new_checkpoint(checkpoint_dir,
+                                                  last_checkpoint)
+      logging.info('Found new checkpoint: %s', new_checkpoint)
+      if new_checkpoint is None:
+        # The checkpoints have been removed: keep evaluating the live states,
+        # as model_states is only a restore template at this point.
+        last_checkpoint = new_checkpoint
+        continue
       # Release replicated_model_states.
       del replicated_model_states
-      new_checkpoint = checkpoints.latest_checkpoint(checkpoint_dir)
-      while new_checkpoint == last_checkpoint:
-        # Sleep for a minute.
-        time.sleep(60)
-        new_checkpoint = checkpoints.latest_checkpoint(checkpoint_dir)
-      # There must be a new checkpoint here.
-      logging.info('Found new checkpoint: %s', new_checkpoint)
-      model_states = checkpoints.restore_checkpoint(
-          model_states,
-          checkpoint_dir,
-          global_mesh=None,
-          mesh_axes=None,
-          checkpoint_type=checkpoint_type)
+      if prefetcher is None:
+        model_states = _restore_pmap_model_states(model_states, checkpoint_dir,
+                                                  checkpoint_type,
+                                                  new_checkpoint)
+      step_i = int(model_states.step)
       replicated_model_states = trainer_lib.replicate_model_state(model_states)
+      model_states = _get_restore_template(model_states)
       last_checkpoint = new_checkpoint
 
 
@@ -224,7 +425,7 @@ def evaluate_spmd_model(
   inputs_shape = tf.nest.map_structure(get_shape_dtype, model_inputs)
 
   mesh_shape = model_p.device_mesh.shape
-  device_mesh = mesh_utils.create_device_mesh(mesh_shape)
+  device_mesh = _create_device_mesh(tuple(mesh_shape))
   logging.info('device_mesh: %s', device_mesh)
   global_mesh = maps.Mesh(device_mesh, model_p.mesh_axis_names)
   with maps.mesh(device_mesh, model_p.mesh_axis_names):
@@ -278,15 +479,12 @@ def evaluate_spmd_model(
             reshard_inputs=False)
         # If the last check point evaluated matches max train steps, exit.
         if last_checkpoint is not None:
-          last_ckpt_step = int(last_checkpoint.split('_')[-1])
+          last_ckpt_step = _get_checkpoint_step(last_checkpoint)
           exceeded_ckpt = last_ckpt_step + model_p.train.save_interval_steps
           if exceeded_ckpt >= model_p.train.num_train_steps:
             break
-        new_checkpoint = checkpoints.latest_checkpoint(checkpoint_dir)
-        while new_checkpoint == last_checkpoint:
-          # Sleep for a minute.
-          time.sleep(60)
-          new_checkpoint = checkpoints.latest_checkpoint(checkpoint_dir)
+        new_checkpoint = _wait_for_new_checkpoint(checkpoint_dir,
+                                                  last_checkpoint)
         # There must be a new checkpoint here.
         logging.info('Found new checkpoint: %s', new_checkpoint)
         partitioned_train_state = checkpoints.restore_checkpoint(
@@ -295,7 +493,9 @@ def evaluate_spmd_model(
             global_mesh=global_mesh,
             mesh_axes=partitioned_specs,
             checkpoint_type=checkpoint_type,
-            state_specs=partitioned_specs)
+            state_specs=partitioned_specs,
+            step=_get_checkpoint_step(new_checkpoint)
+            if new_checkpoint else None)
         if multi_host_checkpointing:
           py_utils.sync_global_devices(
               f'checkpointer:restored:{checkpoint_dir}')
@@ -341,35 +541,157 @@ def decode_once(
                            restore_checkpoint_step)
 
 
+@functools.lru_cache(maxsize=None)
+def _create_device_mesh(mesh_shape: Tuple[int, ...]) -> np.ndarray:
+  """Returns the device mesh of shape `mesh_shape`, computed once per shape."""
+  return mesh_utils.create_device_mesh(mesh_shape)
+
+
 def _get_dir_names(input_p: Sequence[InstantiableParams]) -> Sequence[str]:
   """Returns a list of same length for parent dir names for each dataset."""
+  return list(_get_dir_names_from_dataset_names(tuple(p.name for p in input_p)))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_dir_names_from_dataset_names(
+    dataset_names: Tuple[Optional[str], ...]) -> Tuple[str, ...]:
+  """Returns the parent dir names for datasets named `dataset_names`."""
   uniq_names = set()
   ret = []
-  for idx, p in enumerate(input_p):
-    name = p.name or f'decode_test_{idx}'
-    if p.name and p.name in uniq_names:
-      name = f'{p.name}_{idx}'
+  for idx, dataset_name in enumerate(dataset_names):
+    name = dataset_name or f'decode_test_{idx}'
+    if dataset_name and dataset_name in uniq_names:
+      name = f'{dataset_name}_{idx}'
     if name in uniq_names:
       suffix = hashlib.md5(name.encode()).hexdigest()[-5:]
       name = f'{name}_{suffix}'
       assert name not in uniq_names
     uniq_names.add(name)
     ret.append(name)
-  return ret
+  return tuple(ret)
 
 
 def _get_filename(step: base_layer.JTensorOrPartitionSpec) -> str:
   """Returns a filename for the given step."""
   if step.ndim == 0:
-    step_num = jax.device_get(step)
+    step_num = int(jax.device_get(step))
   elif step.ndim == 1:
-    step_num = jax.device_get(step[0])
+    # Fetch all the replicas at once rather than slicing on device first.
+    step_num = int(jax.device_get(step)[0])
   else:
     raise ValueError(
         f'Expecting a replicated 1D global step (got ndim=`{step.ndim}`).')
   return f'decoder_out_{step_num}'
 
 
+def _reshard_to_local_devices(batch: NestedJTensor) -> NestedJTensor:
+  """Reshards `batch` and transfers each shard to its local device.
+
+  The result can be passed as is to a pmap-ed function, which then does not
+  have to transfer its inputs itself.
+
+  Args:
+    batch: The input batch, with a leading batch dimension.
+
+  Returns:
+    The resharded batch, as a ShardedDeviceArray pytree.
+  """
+  batch = tf.nest.map_structure(py_utils.reshard, batch)
+  devices = jax.local_devices()
+  return jax.device_put_sharded(
+      [jax.tree_map(lambda x, i=i: x[i], batch) for i in range(len(devices))],
+      devices)
+
+
+def _make_decoder_out_dirs(basedir: str, dirnames: Sequence[str]) -> None:
+  """Creates the decoder output dirs, without probing for them first."""
+  for s in dirnames:
+    # makedirs() already succeeds on existing dirs; an unconditional call saves
+    # a stat RPC per dir and does not race with other writers.
+    tf.io.gfile.makedirs(os.path.join(basedir, s))
+
+
+def _write_decoder_outputs(filenames: Sequence[str],
+                           decodes: Sequence[Sequence[Any]]) -> None:
+  """Writes the decoder outputs of all the splits in parallel."""
+
+  def write(output_file, split_decodes):
+    logging.info('Writing decoder output to %s with %d entries', output_file,
+                 len(split_decodes))
+    io_utils.WriteKeyValuePairs(output_file, split_decodes)
+
+  if not filenames:
+    return
+  with futures.ThreadPoolExecutor(max_workers=min(len(filenames), 8)) as pool:
+    # Consume the results to surface any write error.
+    list(pool.map(write, filenames, decodes))
+
+
+class _InputPrefetcher:
+  """Fetches the batches of an input pipeline ahead in a background thread.
+
+  This overlaps the host-side input fetching and preprocessing with the device
+  computation of the previous batches.
+  """
+
+  def __init__(self,
+               input_pipeline: Any,
+               num_batches: int,
+               preprocess_fn: Optional[Callable[[NestedJTensor],
+                                                NestedJTensor]] = None,
+               prefetch_size: int = 2,
+               first_batch: Optional[NestedJTensor] = None) -> None:
+    """Constructor.
+
+    Args:
+      input_pipeline: The instantiated input pipeline to fetch batches from.
+      num_batches: The number of batches to fetch, or -1 to fetch batches until
+        the input pipeline raises `tf.errors.OutOfRangeError`.
+      preprocess_fn: Optional function applied to each batch in the background
+        thread.
+      prefetch_size: The maximum number of batches fetched ahead.
+      first_batch: Optional batch already fetched from `input_pipeline`, to
+        return (and count) before fetching the next ones.
+    """
+    self._input_pipeline = input_pipeline
+    self._first_batch = first_batch
+    self._num_batches = num_batches
+    self._preprocess_fn = preprocess_fn
+    self._queue = queue.Queue(maxsize=prefetch_size)
+    threading.Thread(
+        target=self._run, name='input_prefetcher', daemon=True).start()
+
+  def _run(self) -> None:
+    try:
+      step_num = 0
+      while self._num_batches < 0 or step_num < self._num_batches:
+        step_num += 1
+        if self._first_batch is not None:
+          batch, self._first_batch = self._first_batch, None
+        else:
+          try:
+            batch = self._input_pipeline.get_next()
+          except tf.errors.OutOfRangeError:
+            break
+        if self._preprocess_fn is not None:
+          batch = self._preprocess_fn(batch)
+        self._queue.put((batch, None))
+    except Exception as e:  # pylint: disable=broad-except
+      self._queue.put((None, e))
+      return
+    # Signals the end of the input.
+    self._queue.put((None, None))
+
+  def __iter__(self) -> Iterator[NestedJTensor]:
+    while True:
+      batch, error = self._queue.get()
+      if error is not None:
+        raise error
+      if batch is None:
+        return
+      yield batch
+
+
 def decode_once_pmap_model(
     model_p: InstantiableParams,
     input_p: Sequence[InstantiableParams],
@@ -404,6 +726,9 @@ def decode_once_pmap_model(
         mesh_axes=None,
         step=restore_checkpoint_step,
         checkpoint_type=checkpoint_type)
+  # Compute the output filename from the unreplicated global step, to not have
+  # to fetch it back from the devices.
+  filename = _get_filename(model_states.step)
   replicated_model_states = trainer_lib.replicate_model_state(model_states)
   del model_states
   logging.info('replicated_model_states: %s',
@@ -449,32 +774,25 @@ def decode_once_pmap_model(
   ]
   decodes = [list() for _ in input_p]
   for split, num_split_steps in enumerate(num_steps):
-    step_num = 0
-    while num_split_steps < 0 or step_num < num_split_steps:
-      step_num += 1
-      try:
-        batch = inputs[split].get_next()
-      except tf.errors.OutOfRangeError:
-        break
-      batch = tf.nest.map_structure(py_utils.reshard, batch)
+    # Also transfer the batches to the devices in the background thread.
+    prefetcher = _InputPrefetcher(
+        inputs[split],
+        num_split_steps,
+        preprocess_fn=_reshard_to_local_devices)
+    for batch in prefetcher:
       out = decode_step_func(batch)
       if jax.process_index() == 0:
         processed = jax_model.process_decode_out(inputs[split], out)
         decodes[split].extend(processed)
 
-  basedir = os.path.join(job_log_dir, 'decoder_out')
-  dirnames = _get_dir_names(input_p)
-  filename = _get_filename(replicated_model_states.step)
-  for s in dirnames:
-    dir_path = os.path.join(basedir, s)
-    if not tf.io.gfile.exists(dir_path):
-      tf.io.gfile.makedirs(dir_path)
-  filenames = [os.path.join(basedir, s, filename) for s in dirnames]
+  # Only process 0 writes the decoder outputs, so the other processes do not
+  # need to touch the output dirs at all.
   if jax.process_index() == 0:
-    for split, output_file in enumerate(filenames):
-      logging.info('Writing decoder output to %s with %d entries', output_file,
-                   len(decodes[split]))
-      io_utils.WriteKeyValuePairs(output_file, decodes[split])
+    basedir = os.path.join(job_log_dir, 'decoder_out')
+    dirnames = _get_dir_names(input_p)
+    _make_decoder_out_dirs(basedir, dirnames)
+    filenames = [os.path.join(basedir, s, filename) for s in dirnames]
+    _write_decoder_outputs(filenames, decodes)
 
 
 def decode_once_spmd_model(
@@ -518,7 +836,10 @@ def decode_once_spmd_model(
     y = jax.ShapeDtypeStruct(x_shape, x.dtype)
     return y
 
-  sample_inputs = input_p[0].Instantiate().get_next()
+  # The sample batch is fed to the decoder later on, so that the first input
+  # pipeline does not need to be instantiated twice.
+  inputs = [p.Instantiate() for p in input_p]
+  sample_inputs = inputs[0].get_next()
   inputs_shape = tf.nest.map_structure(get_shape_dtype, sample_inputs)
 
   # TODO(b/198356509): This is a hack for now as we need to change some
@@ -534,12 +855,11 @@ def decode_once_spmd_model(
       mode='decode')
 
   mesh_shape = model_p.device_mesh.shape
-  device_mesh = mesh_utils.create_device_mesh(mesh_shape)
+  device_mesh = _create_device_mesh(tuple(mesh_shape))
   logging.info('device_mesh: %s', device_mesh)
-  if jax.process_index() == 0:
-    # The instantiated model is only used for processing decode
-    # outputs, which only happens on process 0.
-    jax_model = model_p.Instantiate()
+  # The instantiated model is only used for processing decode outputs, which
+  # only happens on process 0. It is lazily instantiated on first use.
+  jax_model = None
   global_mesh = maps.Mesh(device_mesh, model_p.mesh_axis_names)
   with maps.mesh(device_mesh, model_p.mesh_axis_names):
     partitioned_train_state, partitioned_specs, decode_step_fn = (
@@ -574,33 +894,28 @@ def decode_once_spmd_model(
     num_steps = [
         -1 if p.reset_for_eval else p.eval_loop_num_batches for p in input_p
     ]
-    inputs = [p.Instantiate() for p in input_p]
     decodes = [list() for _ in input_p]
     for split, num_split_steps in enumerate(num_steps):
-      step_num = 0
-      while num_split_steps < 0 or step_num < num_split_steps:
-        step_num += 1
-        try:
-          batch = inputs[split].get_next()
-        except tf.errors.OutOfRangeError:
-          break
+      prefetcher = _InputPrefetcher(
+          inputs[split],
+          num_split_steps,
+          first_batch=sample_inputs if split == 0 else None)
+      for batch in prefetcher:
         out = spmd_decode_step_fn(batch)
         # Gathers all local shards to a SDA.
         out = py_utils.maybe_gda_to_sda(out)
         if jax.process_index() == 0:
+          if jax_model is None:
+            jax_model = model_p.Instantiate()
           processed = jax_model.process_decode_out(inputs[split], out)
           decodes[split].extend(processed)
 
-  basedir = os.path.join(job_log_dir, 'decoder_out')
-  dirnames = _get_dir_names(input_p)
-  filename = _get_filename(partitioned_train_state.step)
-  for s in dirnames:
-    dir_path = os.path.join(basedir, s)
-    if not tf.io.gfile.exists(dir_path):
-      tf.io.gfile.makedirs(dir_path)
-  filenames = [os.path.join(basedir, s, filename) for s in dirnames]
+  # Only process 0 writes the decoder outputs, so the other processes do not
+  # need to touch the output dirs at all.
   if jax.process_index() == 0:
-    for split, output_file in enumerate(filenames):
-      logging.info('Writing decoder output to %s with %d entries', output_file,
-                   len(decodes[split]))
-      io_utils.WriteKeyValuePairs(output_file, decodes[split])
+    basedir = os.path.join(job_log_dir, 'decoder_out')
+    dirnames = _get_dir_names(input_p)
+    filename = _get_filename(partitioned_train_state.step)
+    _make_decoder_out_dirs(basedir, dirnames)
+    filenames = [os.path.join(basedir, s, filename) for s in dirnames]
+    _write_decoder_outputs(filenames, decodes)
@@ -61,9 +61,10 @@ def causal_mask(input_t: JTensor) -> JTensor:
           input_t.dtype == jnp.bfloat16), input_t.dtype
   large_negative_number = _get_large_negative_number(input_t.dtype)
   t = input_t.shape[1]
-  col_idx = jnp.tile(jnp.arange(t)[jnp.newaxis, :], [t, 1])
-  row_idx = jnp.tile(jnp.arange(t)[:, jnp.newaxis], [1, t])
-  mask = (row_idx < col_idx).astype(input_t.dtype) * large_negative_number
+  # jnp.tri() lowers to a bare iota/compare, rather than materializing tiled
+  # index tensors.
+  mask = jnp.logical_not(jnp.tri(t, dtype=jnp.bool_))
+  mask = mask.astype(input_t.dtype) * large_negative_number
   return mask[jnp.newaxis, jnp.newaxis, :, :]
 
 
@@ -93,6 +93,10 @@ class SingleShardFullSoftmax(base_layer.BaseLayer):
     p.Define('num_classes', 0, 'Total number of target classes.')
     p.Define('soft_cap_logits', 0.,
              'If not None logits are soft capped to this value.')
+    p.Define(
+        'label_smoothing_prob', 0.0,
+        'If > 0.0, smooth out the one-hot targets given by class_ids by '
+        'spreading this amount of prob mass to all other classes.')
     return p
 
   def __init__(self, params: InstantiableParams) -> None:
@@ -173,11 +177,22 @@ class SingleShardFullSoftmax(base_layer.BaseLayer):
     log_probs = jax.nn.log_softmax(logits)
 
     if class_probabilities is None:
-      class_probabilities = jax.nn.one_hot(
-          jnp.squeeze(class_ids, axis=-1), p.num_classes)
-      class_probabilities = jax.lax.stop_gradient(class_probabilities)
-
-    per_example_xent = -jnp.sum(log_probs * class_probabilities, axis=-1)
+      # Gathers the log probs of the target classes, so that no one-hot
+      # [..., num_classes] targets are materialized. Like with one-hot
+      # targets, out-of-range (e.g. padding) ids select no class at all.
+      valid_ids = (class_ids >= 0) & (class_ids < p.num_classes)
+      label_log_probs = jnp.take_along_axis(
+          log_probs, jnp.where(valid_ids, class_ids, 0), axis=-1)
+      label_log_probs = jnp.squeeze(
+          jnp.where(valid_ids, label_log_probs, 0.0), axis=-1)
+      per_example_xent = -label_log_probs
+      if p.label_smoothing_prob > 0.0:
+        fill_prob = p.label_smoothing_prob / (p.num_classes - 1)
+        other_log_probs = jnp.sum(log_probs, axis=-1) - label_log_probs
+        per_example_xent = -((1.0 - p.label_smoothing_prob) * label_log_probs +
+                             fill_prob * other_log_probs)
+    else:
+      per_example_xent = -jnp.sum(log_probs * class_probabilities, axis=-1)
     per_example_argmax = jax.lax.stop_gradient(jnp.argmax(logits, axis=-1))
 
     # Compute total softmax for the entire sequence
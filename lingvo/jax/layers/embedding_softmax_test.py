@@ -221,6 +221,37 @@ class EmbeddingSoftmaxTest(test_util.JaxTestCase):
     for k in outputs.keys():
       self.assertAllClose(to_np(outputs[k]), to_np(tf_output[k]))
 
+  def test_single_sharded_softmax_layer_label_smoothing(self):
+    p = embedding_softmax.SingleShardFullSoftmax.Params().Set(
+        name='jax_softmax', num_classes=50, input_dims=40)
+    smoothed_p = p.Copy().Set(label_smoothing_prob=0.1)
+    softmax_layer = p.Instantiate()
+    smoothed_softmax_layer = smoothed_p.Instantiate()
+    prng_key = jax.random.PRNGKey(seed=1234)
+    initial_vars = softmax_layer.instantiate_variables(prng_key)
+    npy_input = np.random.normal(1.5, 2.0, [8, 10, p.input_dims])
+    inputs = jnp.asarray(npy_input)
+    class_weights = np.random.normal(1.5, 2.0, [8, 10, 1])
+    class_ids = np.random.randint(0, p.num_classes, [8, 10, 1])
+    # Out-of-range ids, e.g. padding, select no class.
+    class_ids[0, 0] = -1
+    class_ids[1, 2] = p.num_classes
+    # The smoothed targets, built explicitly.
+    one_hot = (np.arange(p.num_classes) == class_ids).astype(np.float32)
+    fill_prob = smoothed_p.label_smoothing_prob / (p.num_classes - 1)
+    class_probabilities = ((1.0 - smoothed_p.label_smoothing_prob) * one_hot +
+                           fill_prob * (1.0 - one_hot))
+    outputs = smoothed_softmax_layer.fprop(
+        initial_vars, inputs, class_weights, class_ids=class_ids)
+    expected_outputs = softmax_layer.fprop(
+        initial_vars,
+        inputs,
+        class_weights,
+        class_probabilities=class_probabilities)
+    for k in outputs.keys():
+      self.assertAllClose(
+          to_np(outputs[k]), to_np(expected_outputs[k]), atol=1e-5)
+
   def test_simple_softmax_layer_value_error(self):
     batch_size = 8
     num_classes = 50
@@ -15,7 +15,10 @@
 # ==============================================================================
 """Tests for lingvo Jax transformer layers."""
 
+import functools
 import itertools
+import os
+import tempfile
 
 from absl import logging
 from absl.testing import absltest
@@ -23,6 +26,7 @@ from absl.testing import parameterized
 import jax
 from jax import numpy as jnp
 from jax import test_util
+from jax.experimental.compilation_cache import compilation_cache
 from lingvo.core import batch_major_attention
 from lingvo.core import layers_with_attention
 from lingvo.jax import base_layer
@@ -36,88 +40,183 @@ import numpy as np
 import tensorflow.compat.v2 as tf
 
 
+def _generate_inputs_and_paddings(batch_size, seq_len, dims):
+  """Returns random float32 [B, T, D] inputs and unpadded [B, T] paddings."""
+  npy_inputs = np.random.normal(
+      1.0, 0.5, [batch_size, seq_len, dims]).astype(np.float32)
+  # None of the positions are padded, so there is nothing to sample.
+  npy_paddings = np.zeros([batch_size, seq_len], dtype=np.float32)
+  return npy_inputs, npy_paddings
+
+
+def _small_transformer_params(**kwargs):
+  """Returns the params of the small causal Transformer shared by tests."""
+  return transformers.Transformer.Params().Set(
+      name='jax_transformer_layer',
+      input_dims=8,
+      hidden_dims=32,
+      num_heads=4,
+      mask_self_attention=True,
+      **kwargs)
+
+
+def _time_major_mask_rows(mask, seq_len):
+  """Returns the per-step rows of a mask, with the query time axis leading.
+
+  Args:
+    mask: A JTensor of shape [B, 1, T, S], or [B, 1, 1, S] when every query
+      step shares the same row.
+    seq_len: The number of query steps T.
+
+  Returns:
+    A JTensor of shape [T, B, 1, S], to be scanned over one row at a time.
+  """
+  batch_size, num_heads, _, source_len = mask.shape
+  mask = jnp.broadcast_to(mask, (batch_size, num_heads, seq_len, source_len))
+  return jnp.transpose(mask, [2, 0, 1, 3])
+
+
+@functools.partial(jax.jit, static_argnames=('causal',))
+def _compute_attention_mask(paddings, segment_ids=None, causal=True):
+  """Returns the self-attention mask, broadcastable to [B, 1, T, T].
+
+  The padding, causal and segment masks are combined in a single jitted
+  computation, which XLA fuses into one elementwise kernel.
+
+  Args:
+    paddings: A JTensor of shape [B, T].
+    segment_ids: An optional JTensor of shape [B, T], for packed inputs.
+    causal: Whether to also apply the causal mask.
+
+  Returns:
+    The combined attention mask.
+  """
+  attention_mask = attentions.convert_paddings_to_mask(paddings)
+  if causal:
+    attention_mask = jnp.minimum(
+        attention_mask, attentions.causal_mask(paddings[:, :, jnp.newaxis]))
+  if segment_ids is not None:
+    attention_mask = jnp.minimum(
+        attention_mask, attentions.segment_mask(segment_ids, dtype=np.float32))
+  return attention_mask
+
+
+@jax.jit
+def _compute_cross_attention_mask(cross_paddings,
+                                  segment_ids=None,
+                                  source_segment_ids=None):
+  """Returns the cross-attention mask, broadcastable to [B, 1, T, S].
+
+  Args:
+    cross_paddings: A JTensor of shape [B, S].
+    segment_ids: An optional JTensor of shape [B, T], for packed inputs.
+    source_segment_ids: A JTensor of shape [B, S], required if segment_ids is
+      set.
+
+  Returns:
+    The combined cross-attention mask.
+  """
+  cross_attention_mask = attentions.convert_paddings_to_mask(cross_paddings)
+  if segment_ids is not None:
+    cross_attention_mask = jnp.minimum(
+        cross_attention_mask,
+        attentions.segment_mask(
+            segment_ids, source_segment_ids, dtype=np.float32))
+  return cross_attention_mask
+
+
 class TransformersTest(test_util.JaxTestCase):
 
   def setUp(self):
     super().setUp()
     np.random.seed(123456)
     tf.random.set_seed(123)
+    self._rng = np.random.default_rng(123456)
 
-  @parameterized.parameters(*list(itertools.product([True, False], repeat=3)))
-  def test_transformer_layer(self, mask_self_attention, packed_input,
-                             cross_attention):
+  @parameterized.parameters(True, False)
+  def test_transformer_layer(self, cross_attention):
+    # The Jax layer only sees mask_self_attention and packed_input through the
+    # attention masks, so all the mask variants share a single layer and run as
+    # one vmapped fprop.
+    mask_variants = list(itertools.product([True, False], repeat=2))
     p = transformers.Transformer.Params().Set(
         name='jax_transformer_layer',
         input_dims=32,
         hidden_dims=128,
         num_heads=8,
-        mask_self_attention=mask_self_attention,
-        packed_input=packed_input,
         cross_attention=cross_attention)
     seq_len = np.random.randint(10, 32)
     batch_size = 10
     transformer_layer = p.Instantiate()
     prng_key = jax.random.PRNGKey(seed=123)
     initial_vars = transformer_layer.instantiate_variables(prng_key)
-    npy_inputs = np.random.normal(
-        1.0, 0.5, [batch_size, seq_len, p.input_dims]).astype('float32')
-    inputs = jnp.asarray(npy_inputs)
-    npy_paddings = np.random.randint(0, 1,
-                                     [batch_size, seq_len]).astype('float32')
-    paddings = jnp.asarray(npy_paddings)
-    causal_mask = None
-    segment_mask = None
-    tf_segment_mask = None
-    attention_mask = attentions.convert_paddings_to_mask(paddings)
-    if mask_self_attention:
-      causal_mask = attentions.causal_mask(inputs)
-      attention_mask = jnp.minimum(attention_mask, causal_mask)
-    if packed_input:
-      segment_ids = np.random.random_integers(0, 2, [batch_size, seq_len])
-      segment_mask = attentions.segment_mask(segment_ids, dtype=np.float32)
-      attention_mask = jnp.minimum(attention_mask, segment_mask)
-      if mask_self_attention:
-        tf_segment_mask = batch_major_attention.CausalSegmentMask(
-            segment_ids, tf.float32)
-      else:
-        tf_segment_mask = batch_major_attention.SegmentMask(
-            segment_ids, segment_ids)
+    npy_inputs, npy_paddings = _generate_inputs_and_paddings(
+        batch_size, seq_len, p.input_dims)
+    inputs, paddings = jax.device_put((npy_inputs, npy_paddings))
+    segment_ids = self._rng.integers(
+        0, 3, [batch_size, seq_len], dtype=np.int32)
 
     cross_inputs = None
-    cross_attention_mask = None
+    cross_paddings = None
+    source_segment_ids = None
     tf_cross_inputs = None
     tf_cross_paddings = None
-    tf_cross_segment_mask = None
     if cross_attention:
       cross_seq_len = np.random.randint(10, 128)
-      npy_cross_inputs = np.random.normal(
-          1.0, 0.5, [batch_size, cross_seq_len, p.input_dims]).astype('float32')
-      cross_inputs = jnp.asarray(npy_cross_inputs)
+      npy_cross_inputs, npy_cross_paddings = _generate_inputs_and_paddings(
+          batch_size, cross_seq_len, p.input_dims)
+      cross_inputs, cross_paddings = jax.device_put(
+          (npy_cross_inputs, npy_cross_paddings))
       tf_cross_inputs = tf.constant(npy_cross_inputs, dtype=tf.float32)
-      npy_cross_paddings = np.random.randint(
-          0, 1, [batch_size, cross_seq_len]).astype('float32')
-      cross_paddings = jnp.asarray(npy_cross_paddings)
-      cross_attention_mask = attentions.convert_paddings_to_mask(cross_paddings)
       tf_cross_paddings = tf.constant(npy_cross_paddings, dtype=tf.float32)
-      if packed_input:
-        source_segment_ids = np.random.random_integers(
-            0, 2, [batch_size, cross_seq_len])
-        cross_segment_mask = attentions.segment_mask(
-            segment_ids, source_segment_ids, dtype=np.float32)
-        cross_attention_mask = jnp.minimum(cross_attention_mask,
-                                           cross_segment_mask)
-        tf_cross_segment_mask = batch_major_attention.SegmentMask(
-            segment_ids, source_segment_ids)
+      source_segment_ids = self._rng.integers(
+          0, 3, [batch_size, cross_seq_len], dtype=np.int32)
 
-    with base_layer.JaxContext.new_context(
-        prng_key=prng_key, global_step=jnp.array(0, dtype=jnp.uint32)):
-      outputs, _ = transformer_layer.fprop(
-          initial_vars,
-          inputs,
-          paddings,
-          attention_mask=attention_mask,
-          cross_inputs=cross_inputs,
-          cross_attention_mask=cross_attention_mask)
+    # Tracing the whole fprop once is much cheaper than dispatching each op.
+    # The masks are built in the same trace so that XLA can fuse them into the
+    # attention computation.
+    @jax.jit
+    def fprop(theta, prng_key, inputs, paddings, segment_ids, cross_inputs,
+              cross_paddings, source_segment_ids):
+      attention_masks = []
+      cross_attention_masks = []
+      for mask_self_attention, packed_input in mask_variants:
+        variant_segment_ids = segment_ids if packed_input else None
+        # Broadcast to [B, 1, T, T], so that the variants can be stacked.
+        attention_mask = jnp.broadcast_to(
+            _compute_attention_mask(
+                paddings, variant_segment_ids, causal=mask_self_attention),
+            [batch_size, 1, seq_len, seq_len])
+        attention_masks.append(attention_mask)
+        if cross_attention:
+          cross_attention_mask = jnp.broadcast_to(
+              _compute_cross_attention_mask(cross_paddings,
+                                            variant_segment_ids,
+                                            source_segment_ids),
+              [batch_size, 1, seq_len, cross_paddings.shape[1]])
+          cross_attention_masks.append(cross_attention_mask)
+      attention_masks = jnp.stack(attention_masks)
+      cross_attention_masks = (
+          jnp.stack(cross_attention_masks) if cross_attention else None)
+
+      def fprop_variant(attention_mask, cross_attention_mask):
+        outputs, _ = transformer_layer.fprop(
+            theta,
+            inputs,
+            paddings,
+            attention_mask=attention_mask,
+            cross_inputs=cross_inputs,
+            cross_attention_mask=cross_attention_mask)
+        return outputs
+
+      with base_layer.JaxContext.new_context(
+          prng_key=prng_key, global_step=jnp.array(0, dtype=jnp.uint32)):
+        return jax.vmap(fprop_variant)(attention_masks, cross_attention_masks)
+
+    # [V, B, T, D], one slice per entry of mask_variants.
+    outputs = fprop(initial_vars, prng_key, inputs, paddings, segment_ids,
+                    cross_inputs, cross_paddings, source_segment_ids)
+    np_outputs = test_utils.to_np(outputs)
     logging.info('initial_vars in transformer layer = %s', initial_vars)
 
     # Test whether tf Transformer layer returns same output
@@ -126,40 +225,48 @@ class TransformersTest(test_util.JaxTestCase):
         initial_vars, cross_attention)
     tf_initial_vars = test_utils.to_tf_nmap(tf_initial_vars)
     logging.info('tf_initial_vars in transformer layer = %s', initial_vars)
-    tf_p = batch_major_attention.TransformerLayer.Params().Set(
-        name='tf_transformer_layer',
-        input_dim=p.input_dims,
-        num_heads=p.num_heads,
-        mask_self_atten=mask_self_attention,
-        packed_input=packed_input,
-        has_aux_atten=cross_attention)
-    tf_p.tr_fflayer_tpl.hidden_dim = p.hidden_dims
-    tf_p.tr_fflayer_tpl.fflayer_tpl.batch_norm = False
-    tf_p.tr_fflayer_tpl.fflayer_tpl.has_bias = True
-    tf_transformer_layer = tf_p.Instantiate()
-    tf_output, _ = tf_transformer_layer.FProp(
-        tf_initial_vars,
-        tf.constant(npy_inputs, dtype=tf.float32),
-        paddings=test_utils.to_tf_nmap(npy_paddings),
-        segment_mask=tf_segment_mask,
-        aux_vec=tf_cross_inputs,
-        aux_paddings=tf_cross_paddings,
-        aux_segment_mask=test_utils.to_tf_nmap(tf_cross_segment_mask))
-    np_outputs = test_utils.to_np(outputs)
-    tf_np_outputs = test_utils.to_np(tf_output)
-    self.assertAllClose(tf_np_outputs, np_outputs, atol=1e-5)
+    for i, (mask_self_attention, packed_input) in enumerate(mask_variants):
+      with self.subTest(
+          mask_self_attention=mask_self_attention, packed_input=packed_input):
+        tf_segment_mask = None
+        tf_cross_segment_mask = None
+        if packed_input:
+          if mask_self_attention:
+            tf_segment_mask = batch_major_attention.CausalSegmentMask(
+                segment_ids, tf.float32)
+          else:
+            tf_segment_mask = batch_major_attention.SegmentMask(
+                segment_ids, segment_ids)
+          if cross_attention:
+            tf_cross_segment_mask = batch_major_attention.SegmentMask(
+                segment_ids, source_segment_ids)
+        tf_p = batch_major_attention.TransformerLayer.Params().Set(
+            name='tf_transformer_layer',
+            input_dim=p.input_dims,
+            num_heads=p.num_heads,
+            mask_self_atten=mask_self_attention,
+            packed_input=packed_input,
+            has_aux_atten=cross_attention)
+        tf_p.tr_fflayer_tpl.hidden_dim = p.hidden_dims
+        tf_p.tr_fflayer_tpl.fflayer_tpl.batch_norm = False
+        tf_p.tr_fflayer_tpl.fflayer_tpl.has_bias = True
+        tf_transformer_layer = tf_p.Instantiate()
+        tf_output, _ = tf_transformer_layer.FProp(
+            tf_initial_vars,
+            tf.constant(npy_inputs, dtype=tf.float32),
+            paddings=test_utils.to_tf_nmap(npy_paddings),
+            segment_mask=tf_segment_mask,
+            aux_vec=tf_cross_inputs,
+            aux_paddings=tf_cross_paddings,
+            aux_segment_mask=test_utils.to_tf_nmap(tf_cross_segment_mask))
+        tf_np_outputs = test_utils.to_np(tf_output)
+        self.assertAllClose(tf_np_outputs, np_outputs[i], atol=1e-5)
 
   @parameterized.parameters(*list(itertools.product([True, False], repeat=4)))
   def test_transformer_layer_extendstep(self, packed_input, cross_attention,
                                         dconv_qkv, use_rotary_position_emb):
-    p = transformers.Transformer.Params().Set(
-        name='jax_transformer_layer',
-        input_dims=8,
-        hidden_dims=32,
-        num_heads=4,
-        mask_self_attention=True,
-        packed_input=packed_input,
-        cross_attention=cross_attention)
+    p = _small_transformer_params(
+        packed_input=packed_input, cross_attention=cross_attention)
     p.tr_atten_tpl.dconv_qkv = dconv_qkv
     p.tr_atten_tpl.use_rotary_position_emb = use_rotary_position_emb
     if cross_attention:
@@ -175,87 +282,85 @@ class TransformersTest(test_util.JaxTestCase):
     transformer_layer = p.Instantiate()
     prng_key = jax.random.PRNGKey(seed=123)
     initial_vars = transformer_layer.instantiate_variables(prng_key)
-    initial_states = transformer_layer.init_states(initial_vars, batch_size,
-                                                   seq_len)
-    npy_inputs = np.random.normal(
-        1.0, 0.5, [batch_size, seq_len, p.input_dims]).astype('float32')
-    inputs = jnp.asarray(npy_inputs)
-    npy_paddings = np.random.randint(0, 1,
-                                     [batch_size, seq_len]).astype('float32')
-    # npy_paddings = np.zeros([batch_size, seq_len])
-    paddings = jnp.asarray(npy_paddings)
-    attention_mask = attentions.convert_paddings_to_mask(paddings)
-    segment_mask = None
-    causal_mask = attentions.causal_mask(inputs)
-    attention_mask = jnp.minimum(causal_mask, attention_mask)
+    npy_inputs, npy_paddings = _generate_inputs_and_paddings(
+        batch_size, seq_len, p.input_dims)
+    inputs, paddings = jax.device_put((npy_inputs, npy_paddings))
+    segment_ids = None
     if packed_input:
-      segment_ids = np.random.random_integers(0, 2, [batch_size, seq_len])
-      segment_mask = attentions.segment_mask(segment_ids, dtype=np.float32)
-      attention_mask = jnp.minimum(attention_mask, segment_mask)
+      segment_ids = self._rng.integers(
+          0, 3, [batch_size, seq_len], dtype=np.int32)
     cross_inputs = None
     cross_paddings = None
-    cross_attention_mask = None
+    source_segment_ids = None
     if cross_attention:
       cross_seq_len = np.random.randint(10, 32)
-      npy_cross_inputs = np.random.normal(
-          1.0, 0.5, [batch_size, cross_seq_len, p.input_dims]).astype('float32')
-      cross_inputs = jnp.asarray(npy_cross_inputs)
-      npy_cross_paddings = np.random.randint(
-          0, 1, [batch_size, cross_seq_len]).astype('float32')
-      cross_paddings = jnp.asarray(npy_cross_paddings)
-      cross_attention_mask = attentions.convert_paddings_to_mask(cross_paddings)
+      npy_cross_inputs, npy_cross_paddings = _generate_inputs_and_paddings(
+          batch_size, cross_seq_len, p.input_dims)
+      cross_inputs, cross_paddings = jax.device_put(
+          (npy_cross_inputs, npy_cross_paddings))
       if packed_input:
-        source_segment_ids = np.random.random_integers(
-            0, 2, [batch_size, cross_seq_len])
-        cross_segment_mask = attentions.segment_mask(
-            segment_ids, source_segment_ids, dtype=np.float32)
-        cross_attention_mask = jnp.minimum(cross_attention_mask,
-                                           cross_segment_mask)
+        source_segment_ids = self._rng.integers(
+            0, 3, [batch_size, cross_seq_len], dtype=np.int32)
 
-    with base_layer.JaxContext.new_context(
-        prng_key=prng_key, global_step=jnp.array(0, dtype=jnp.uint32)):
-      fprop_outputs, _ = transformer_layer.fprop(
-          initial_vars,
-          inputs,
-          paddings,
-          attention_mask=attention_mask,
-          cross_inputs=cross_inputs,
-          cross_attention_mask=cross_attention_mask)
-      decoder_outputs = jnp.zeros(shape=[seq_len, batch_size, p.input_dims])
-      atten_states = initial_states
-      for t in range(seq_len):
-        attention_mask_t = attention_mask[:, :, t, :]
-        cross_attention_mask_t = cross_attention_mask
+    # Runs fprop and the decode scan under a single JaxContext and a single
+    # compilation. The masks are built in the same trace as the attention
+    # computation.
+    @jax.jit
+    def fprop_and_decode(theta, prng_key, inputs, paddings, segment_ids,
+                         cross_inputs, cross_paddings, source_segment_ids):
+      initial_states = transformer_layer.init_states(theta, batch_size, seq_len)
+      attention_mask = _compute_attention_mask(paddings, segment_ids)
+      cross_attention_mask = None
+      if cross_attention:
+        cross_attention_mask = _compute_cross_attention_mask(
+            cross_paddings, segment_ids, source_segment_ids)
+
+      def extend_step(atten_states, xs):
+        t, inputs_t, attention_mask_t, cross_attention_mask_t = xs
         if cross_attention:
-          cross_attention_mask_t = cross_attention_mask[:, :, t, :]
-          cross_attention_mask_t = np.expand_dims(
-              cross_attention_mask_t, axis=2)
-        atten_states, encoded = transformer_layer.extend_step(
-            initial_vars,
+          # [B, 1, S] -> [B, 1, 1, S].
+          cross_attention_mask_t = cross_attention_mask_t[:, :, jnp.newaxis]
+        return transformer_layer.extend_step(
+            theta,
             atten_states,
-            inputs=inputs[:, t, :],
+            inputs=inputs_t,
             time_step=t,
             attention_mask=attention_mask_t,
             cross_inputs=cross_inputs,
             cross_attention_mask=cross_attention_mask_t)
-        decoder_outputs = decoder_outputs.at[t].set(encoded)
 
+      with base_layer.JaxContext.new_context(
+          prng_key=prng_key, global_step=jnp.array(0, dtype=jnp.uint32)):
+        fprop_outputs, _ = transformer_layer.fprop(
+            theta,
+            inputs,
+            paddings,
+            attention_mask=attention_mask,
+            cross_inputs=cross_inputs,
+            cross_attention_mask=cross_attention_mask)
+        # Decodes all the steps with a single compiled scan body. The inputs
+        # and masks are laid out time major, so each step reads one
+        # contiguous leading-axis slice.
+        xs = (jnp.arange(seq_len), jnp.transpose(inputs, [1, 0, 2]),
+              _time_major_mask_rows(attention_mask, seq_len), None)
+        if cross_attention:
+          xs = xs[:3] + (_time_major_mask_rows(cross_attention_mask, seq_len),)
+        _, decoder_outputs = jax.lax.scan(extend_step, initial_states, xs)
+      return fprop_outputs, decoder_outputs
+
+    fprop_outputs, decoder_outputs = fprop_and_decode(
+        initial_vars, prng_key, inputs, paddings, segment_ids, cross_inputs,
+        cross_paddings, source_segment_ids)
     decoder_out_transposed = jnp.transpose(decoder_outputs, [1, 0, 2])
     logging.info('initial_vars in transformer layer = %s', initial_vars)
-    np_fprop_outputs = test_utils.to_np(fprop_outputs)
-    np_decoder_outputs = test_utils.to_np(decoder_out_transposed)
+    np_fprop_outputs, np_decoder_outputs = jax.device_get(
+        (fprop_outputs, decoder_out_transposed))
     self.assertAllClose(np_fprop_outputs, np_decoder_outputs, atol=1e-5)
 
   @parameterized.parameters(True, False)
   def test_transformer_layer_cross_attention_ln(self, packed_input):
-    p = transformers.Transformer.Params().Set(
-        name='jax_transformer_layer',
-        input_dims=8,
-        hidden_dims=32,
-        num_heads=4,
-        mask_self_attention=True,
-        packed_input=packed_input,
-        cross_attention=True)
+    p = _small_transformer_params(
+        packed_input=packed_input, cross_attention=True)
     seq_len = 5
     batch_size = 4
     transformer_layer = p.Instantiate()
@@ -267,19 +372,14 @@ class TransformersTest(test_util.JaxTestCase):
     # Change the cross attention initial vars.
     initial_vars.cross_layer_norm.scale = 15
     initial_vars.cross_layer_norm.bias = 1.5
-    npy_inputs = np.random.normal(
-        1.0, 0.5, [batch_size, seq_len, p.input_dims]).astype('float32')
-    inputs = jnp.asarray(npy_inputs)
-    npy_paddings = np.random.randint(0, 1,
-                                     [batch_size, seq_len]).astype('float32')
-    paddings = jnp.asarray(npy_paddings)
-    attention_mask = attentions.convert_paddings_to_mask(paddings)
-    causal_mask = attentions.causal_mask(inputs)
-    attention_mask = jnp.minimum(causal_mask, attention_mask)
+    npy_inputs, npy_paddings = _generate_inputs_and_paddings(
+        batch_size, seq_len, p.input_dims)
+    inputs, paddings = jax.device_put((npy_inputs, npy_paddings))
+    segment_ids = None
     if packed_input:
-      segment_ids = np.random.random_integers(0, 2, [batch_size, seq_len])
-      segment_mask = attentions.segment_mask(segment_ids, dtype=np.float32)
-      attention_mask = jnp.minimum(attention_mask, segment_mask)
+      segment_ids = self._rng.integers(
+          0, 3, [batch_size, seq_len], dtype=np.int32)
+    attention_mask = _compute_attention_mask(paddings, segment_ids)
     with base_layer.JaxContext.new_context(
         prng_key=prng_key, global_step=jnp.array(0, dtype=jnp.uint32)):
       inputs_normalized = transformer_layer.layer_norm.fprop(
@@ -298,8 +398,8 @@ class TransformersTest(test_util.JaxTestCase):
       # Normalize atten outputs using cross attention.
       atten_output_normalized = transformer_layer.cross_layer_norm.fprop(
           initial_vars.cross_layer_norm, atten_output)
-      inputs_normalized = test_utils.to_np(inputs_normalized)
-      atten_output_normalized = test_utils.to_np(atten_output_normalized)
+      inputs_normalized, atten_output_normalized = jax.device_get(
+          (inputs_normalized, atten_output_normalized))
     self.assertAllClose(
         initial_vars.layer_norm.bias, inputs_normalized.mean(), atol=1e-3)
     self.assertAllClose(
@@ -316,13 +416,7 @@ class TransformersTest(test_util.JaxTestCase):
         atol=5e-3)
 
   def test_transformer_layer_cross_attention_dconv_value_error(self):
-    p = transformers.Transformer.Params().Set(
-        name='jax_transformer_layer',
-        input_dims=8,
-        hidden_dims=32,
-        num_heads=4,
-        cross_attention=True,
-        mask_self_attention=True)
+    p = _small_transformer_params(cross_attention=True)
     # Enable cross attention.
     p.cross_atten_tpl = p.tr_atten_tpl.Copy()
     # Enable depth-wise convolution.
@@ -331,13 +425,7 @@ class TransformersTest(test_util.JaxTestCase):
       p.Instantiate()
 
   def test_transformer_layer_cross_attention_pos_emb_value_error(self):
-    p = transformers.Transformer.Params().Set(
-        name='jax_transformer_layer',
-        input_dims=8,
-        hidden_dims=32,
-        num_heads=4,
-        cross_attention=True,
-        mask_self_attention=True)
+    p = _small_transformer_params(cross_attention=True)
     # Enable cross attention.
     p.cross_atten_tpl = p.tr_atten_tpl.Copy()
     # Enable rotary position embedding.
@@ -393,15 +481,13 @@ class TransformersTest(test_util.JaxTestCase):
     batch_size = 3
     prng_key = jax.random.PRNGKey(seed=123)
     initial_vars = transformer_block.instantiate_variables(prng_key)
-    npy_inputs = np.random.normal(
-        1.0, 0.5, [batch_size, seq_len, block_p.model_dims]).astype('float32')
-    inputs = jnp.asarray(npy_inputs)
-    npy_paddings = np.random.randint(0, 1,
-                                     [batch_size, seq_len]).astype('float32')
-    paddings = jnp.asarray(npy_paddings)
+    npy_inputs, npy_paddings = _generate_inputs_and_paddings(
+        batch_size, seq_len, block_p.model_dims)
+    inputs, paddings = jax.device_put((npy_inputs, npy_paddings))
     segment_mask = None
     if packed_input:
-      segment_ids = np.random.random_integers(0, 2, [batch_size, seq_len])
+      segment_ids = self._rng.integers(
+          0, 3, [batch_size, seq_len], dtype=np.int32)
       segment_mask = attentions.segment_mask(segment_ids, dtype=np.float32)
 
     cross_inputs = None
@@ -409,16 +495,13 @@ class TransformersTest(test_util.JaxTestCase):
     cross_segment_mask = None
     if cross_attention:
       cross_seq_len = np.random.randint(10, 64)
-      npy_cross_inputs = np.random.normal(
-          1.0, 0.5,
-          [batch_size, cross_seq_len, block_p.model_dims]).astype('float32')
-      cross_inputs = jnp.asarray(npy_cross_inputs)
-      npy_cross_paddings = np.random.randint(
-          0, 1, [batch_size, cross_seq_len]).astype('float32')
-      cross_paddings = jnp.asarray(npy_cross_paddings)
+      npy_cross_inputs, npy_cross_paddings = _generate_inputs_and_paddings(
+          batch_size, cross_seq_len, block_p.model_dims)
+      cross_inputs, cross_paddings = jax.device_put(
+          (npy_cross_inputs, npy_cross_paddings))
       if packed_input:
-        source_segment_ids = np.random.random_integers(
-            0, 2, [batch_size, cross_seq_len])
+        source_segment_ids = self._rng.integers(
+            0, 3, [batch_size, cross_seq_len], dtype=np.int32)
         cross_segment_mask = attentions.segment_mask(
             segment_ids, source_segment_ids, dtype=np.float32)
 
@@ -440,8 +523,8 @@ class TransformersTest(test_util.JaxTestCase):
           cross_inputs=cross_inputs,
           cross_paddings=cross_paddings,
           cross_segment_mask=cross_segment_mask)
-    block_np_outputs = test_utils.to_np(block_outputs)
-    stack_np_outputs = test_utils.to_np(stack_outputs)
+    block_np_outputs, stack_np_outputs = jax.device_get(
+        (block_outputs, stack_outputs))
     self.assertAllClose(stack_np_outputs, block_np_outputs, atol=1e-5)
 
   @parameterized.parameters(*list(itertools.product([True, False], repeat=3)))
@@ -461,16 +544,14 @@ class TransformersTest(test_util.JaxTestCase):
     stacked_transformer_layer = p.Instantiate()
     prng_key = jax.random.PRNGKey(seed=123)
     initial_vars = stacked_transformer_layer.instantiate_variables(prng_key)
-    npy_inputs = np.random.normal(
-        1.0, 0.5, [batch_size, seq_len, p.model_dims]).astype('float32')
-    inputs = jnp.asarray(npy_inputs)
-    npy_paddings = np.random.randint(0, 1,
-                                     [batch_size, seq_len]).astype('float32')
-    paddings = jnp.asarray(npy_paddings)
+    npy_inputs, npy_paddings = _generate_inputs_and_paddings(
+        batch_size, seq_len, p.model_dims)
+    inputs, paddings = jax.device_put((npy_inputs, npy_paddings))
     segment_mask = None
     tf_segment_mask = None
     if packed_input:
-      segment_ids = np.random.random_integers(0, 2, [batch_size, seq_len])
+      segment_ids = self._rng.integers(
+          0, 3, [batch_size, seq_len], dtype=np.int32)
       segment_mask = attentions.segment_mask(segment_ids, dtype=np.float32)
       if mask_self_attention:
         tf_segment_mask = batch_major_attention.CausalSegmentMask(
@@ -487,32 +568,36 @@ class TransformersTest(test_util.JaxTestCase):
     tf_cross_segment_mask = None
     if cross_attention:
       cross_seq_len = np.random.randint(10, 64)
-      npy_cross_inputs = np.random.normal(
-          1.0, 0.5, [batch_size, cross_seq_len, p.model_dims]).astype('float32')
-      cross_inputs = jnp.asarray(npy_cross_inputs)
+      npy_cross_inputs, npy_cross_paddings = _generate_inputs_and_paddings(
+          batch_size, cross_seq_len, p.model_dims)
+      cross_inputs, cross_paddings = jax.device_put(
+          (npy_cross_inputs, npy_cross_paddings))
       tf_cross_inputs = tf.constant(npy_cross_inputs, dtype=tf.float32)
-      npy_cross_paddings = np.random.randint(
-          0, 1, [batch_size, cross_seq_len]).astype('float32')
-      cross_paddings = jnp.asarray(npy_cross_paddings)
       tf_cross_paddings = tf.constant(npy_cross_paddings, dtype=tf.float32)
       if packed_input:
-        source_segment_ids = np.random.random_integers(
-            0, 2, [batch_size, cross_seq_len])
+        source_segment_ids = self._rng.integers(
+            0, 3, [batch_size, cross_seq_len], dtype=np.int32)
         cross_segment_mask = attentions.segment_mask(
             segment_ids, source_segment_ids, dtype=np.float32)
         tf_cross_segment_mask = batch_major_attention.SegmentMask(
             segment_ids, source_segment_ids)
 
-    with base_layer.JaxContext.new_context(
-        prng_key=prng_key, global_step=jnp.array(0, dtype=jnp.uint32)):
-      outputs = stacked_transformer_layer.fprop(
-          initial_vars,
-          inputs,
-          paddings,
-          segment_mask=segment_mask,
-          cross_inputs=cross_inputs,
-          cross_paddings=cross_paddings,
-          cross_segment_mask=cross_segment_mask)
+    @jax.jit
+    def fprop(theta, prng_key, inputs, paddings, segment_mask, cross_inputs,
+              cross_paddings, cross_segment_mask):
+      with base_layer.JaxContext.new_context(
+          prng_key=prng_key, global_step=jnp.array(0, dtype=jnp.uint32)):
+        return stacked_transformer_layer.fprop(
+            theta,
+            inputs,
+            paddings,
+            segment_mask=segment_mask,
+            cross_inputs=cross_inputs,
+            cross_paddings=cross_paddings,
+            cross_segment_mask=cross_segment_mask)
+
+    outputs = fprop(initial_vars, prng_key, inputs, paddings, segment_mask,
+                    cross_inputs, cross_paddings, cross_segment_mask)
     logging.info('initial_vars in transformer layer = %s', initial_vars)
 
     # Test whether tf Transformer layer returns same output
@@ -581,22 +666,19 @@ class TransformersTest(test_util.JaxTestCase):
     repeated_transformer_layer.instantiate_variable_configs()
 
     def _StackVars(*args):
-      args = [x[jnp.newaxis, :] for x in args]
-      return jnp.vstack(args)
+      return jnp.stack(args, axis=0)
 
     stacked_vars = py_utils.NestedMap(
         repeat=py_utils.NestedMap(
-            sub=tf.nest.map_structure(_StackVars, *initial_vars.x_layers)))
+            sub=jax.tree_map(_StackVars, *initial_vars.x_layers)))
 
-    npy_inputs = np.random.normal(
-        1.0, 0.5, [batch_size, seq_len, model_dims]).astype('float32')
-    inputs = jnp.asarray(npy_inputs)
-    npy_paddings = np.random.randint(0, 1,
-                                     [batch_size, seq_len]).astype('float32')
-    paddings = jnp.asarray(npy_paddings)
+    npy_inputs, npy_paddings = _generate_inputs_and_paddings(
+        batch_size, seq_len, model_dims)
+    inputs, paddings = jax.device_put((npy_inputs, npy_paddings))
     segment_mask = None
     if packed_input:
-      segment_ids = np.random.random_integers(0, 2, [batch_size, seq_len])
+      segment_ids = self._rng.integers(
+          0, 3, [batch_size, seq_len], dtype=np.int32)
       segment_mask = attentions.segment_mask(segment_ids, dtype=np.float32)
 
     cross_inputs = None
@@ -604,15 +686,13 @@ class TransformersTest(test_util.JaxTestCase):
     cross_segment_mask = None
     if cross_attention:
       cross_seq_len = np.random.randint(10, 64)
-      npy_cross_inputs = np.random.normal(
-          1.0, 0.5, [batch_size, cross_seq_len, model_dims]).astype('float32')
-      cross_inputs = jnp.asarray(npy_cross_inputs)
-      npy_cross_paddings = np.random.randint(
-          0, 1, [batch_size, cross_seq_len]).astype('float32')
-      cross_paddings = jnp.asarray(npy_cross_paddings)
+      npy_cross_inputs, npy_cross_paddings = _generate_inputs_and_paddings(
+          batch_size, cross_seq_len, model_dims)
+      cross_inputs, cross_paddings = jax.device_put(
+          (npy_cross_inputs, npy_cross_paddings))
       if packed_input:
-        source_segment_ids = np.random.random_integers(
-            0, 2, [batch_size, cross_seq_len])
+        source_segment_ids = self._rng.integers(
+            0, 3, [batch_size, cross_seq_len], dtype=np.int32)
         cross_segment_mask = attentions.segment_mask(
             segment_ids, source_segment_ids, dtype=np.float32)
 
@@ -637,12 +717,14 @@ class TransformersTest(test_util.JaxTestCase):
           cross_segment_mask=cross_segment_mask)
       self.assertAllClose(outputs, outputs_repeated, atol=1e-5)
 
-  @parameterized.parameters(*list(itertools.product([True, False], repeat=7)))
+  # The combine_qkv optimization only works for self-attention, so the
+  # cross_attention and combine_qkv variants are left out of the grid.
+  @parameterized.parameters(
+      *[v for v in itertools.product([True, False], repeat=7)
+        if not (v[1] and v[4])])
   def test_stacked_transformer_layer_extendstep(
       self, packed_input, cross_attention, enable_while_loop, use_repeat_layer,
       combine_qkv, dconv_qkv, use_rotary_position_emb):
-    if cross_attention and combine_qkv:
-      self.skipTest('combine_qkv optimization only works for self-attention.')
     if use_repeat_layer:
       layer_params = transformers.StackedTransformerRepeated.Params()
     else:
@@ -675,18 +757,14 @@ class TransformersTest(test_util.JaxTestCase):
     stacked_transformer_layer = p.Instantiate()
     prng_key = jax.random.PRNGKey(seed=123)
     initial_vars = stacked_transformer_layer.instantiate_variables(prng_key)
-    initial_states = stacked_transformer_layer.init_states(
-        initial_vars, batch_size, seq_len)
-    npy_inputs = np.random.normal(
-        1.0, 0.5, [batch_size, seq_len, p.model_dims]).astype('float32')
-    inputs = jnp.asarray(npy_inputs)
-    npy_paddings = np.random.randint(0, 1,
-                                     [batch_size, seq_len]).astype('float32')
-    paddings = jnp.asarray(npy_paddings)
+    npy_inputs, npy_paddings = _generate_inputs_and_paddings(
+        batch_size, seq_len, p.model_dims)
+    inputs, paddings = jax.device_put((npy_inputs, npy_paddings))
     attention_mask = attentions.convert_paddings_to_mask(paddings)
     segment_mask = None
     if packed_input:
-      segment_ids = np.random.random_integers(0, 2, [batch_size, seq_len])
+      segment_ids = self._rng.integers(
+          0, 3, [batch_size, seq_len], dtype=np.int32)
       segment_mask = attentions.segment_mask(segment_ids, dtype=np.float32)
 
     cross_inputs = None
@@ -694,55 +772,80 @@ class TransformersTest(test_util.JaxTestCase):
     cross_segment_mask = None
     if cross_attention:
       cross_seq_len = np.random.randint(10, 32)
-      npy_cross_inputs = np.random.normal(
-          1.0, 0.5, [batch_size, cross_seq_len, p.model_dims]).astype('float32')
-      cross_inputs = jnp.asarray(npy_cross_inputs)
-      npy_cross_paddings = np.random.randint(
-          0, 1, [batch_size, cross_seq_len]).astype('float32')
-      cross_paddings = jnp.asarray(npy_cross_paddings)
+      npy_cross_inputs, npy_cross_paddings = _generate_inputs_and_paddings(
+          batch_size, cross_seq_len, p.model_dims)
+      cross_inputs, cross_paddings = jax.device_put(
+          (npy_cross_inputs, npy_cross_paddings))
       if packed_input:
-        source_segment_ids = np.random.random_integers(
-            0, 2, [batch_size, cross_seq_len])
+        source_segment_ids = self._rng.integers(
+            0, 3, [batch_size, cross_seq_len], dtype=np.int32)
         cross_segment_mask = attentions.segment_mask(
             segment_ids, source_segment_ids, dtype=np.float32)
 
-    prng_key = jax.random.PRNGKey(seed=123)
     global_step = jnp.array(0, dtype=jnp.uint64)
-    with base_layer.JaxContext.new_context(
-        prng_key=prng_key, global_step=global_step):
-      fprop_outputs = stacked_transformer_layer.fprop(
-          initial_vars,
-          inputs,
-          paddings,
-          segment_mask=segment_mask,
-          cross_inputs=cross_inputs,
-          cross_paddings=cross_paddings,
-          cross_segment_mask=cross_segment_mask)
-      decoder_outputs = jnp.zeros(shape=[seq_len, batch_size, p.model_dims])
-      atten_states = initial_states
-      for t in range(seq_len):
-        segment_mask_t = attention_mask[:, :, t, :]
-        cross_segment_mask_t = cross_segment_mask
-        if segment_mask is not None:
-          segment_mask_t = jnp.minimum(segment_mask_t, segment_mask[:, :, t, :])
-        if cross_segment_mask is not None:
-          cross_segment_mask_t = cross_segment_mask[:, :, t, :]
-        atten_states, encoded = stacked_transformer_layer.extend_step(
-            initial_vars,
+
+    @jax.jit
+    def fprop(theta, prng_key, inputs, paddings, segment_mask, cross_inputs,
+              cross_paddings, cross_segment_mask):
+      with base_layer.JaxContext.new_context(
+          prng_key=prng_key, global_step=global_step):
+        return stacked_transformer_layer.fprop(
+            theta,
+            inputs,
+            paddings,
+            segment_mask=segment_mask,
+            cross_inputs=cross_inputs,
+            cross_paddings=cross_paddings,
+            cross_segment_mask=cross_segment_mask)
+
+    # Builds the decode cache and decodes all the steps in one compilation. The
+    # scan body carries the cache and takes the per-step rows of the inputs and
+    # masks.
+    @jax.jit
+    def decode(theta, prng_key, inputs, attention_mask, segment_mask,
+               cross_inputs, cross_paddings, cross_segment_mask):
+      initial_states = stacked_transformer_layer.init_states(
+          theta, batch_size, seq_len)
+      # Merge the padding and segment masks once, so that each step only has
+      # a single row to read.
+      if segment_mask is not None:
+        attention_mask = jnp.minimum(attention_mask, segment_mask)
+
+      def extend_step(atten_states, xs):
+        time_step, inputs_t, segment_mask_t, cross_segment_mask_t = xs
+        return stacked_transformer_layer.extend_step(
+            theta,
             atten_states,
-            inputs=inputs[:, t, :],
-            time_step=t,
+            inputs=inputs_t,
+            time_step=time_step,
             segment_mask=segment_mask_t,
             cross_inputs=cross_inputs,
             cross_paddings=cross_paddings,
             cross_segment_mask=cross_segment_mask_t)
-        decoder_outputs = decoder_outputs.at[t].set(encoded)
+
+      # The inputs and masks are laid out time major, so each step reads one
+      # contiguous leading-axis slice.
+      xs = (jnp.arange(seq_len), jnp.transpose(inputs, [1, 0, 2]),
+            _time_major_mask_rows(attention_mask, seq_len), None)
+      if cross_segment_mask is not None:
+        xs = xs[:3] + (_time_major_mask_rows(cross_segment_mask, seq_len),)
+      with base_layer.JaxContext.new_context(
+          prng_key=prng_key, global_step=global_step):
+        _, decoder_outputs = jax.lax.scan(extend_step, initial_states, xs)
+      return decoder_outputs
+
+    fprop_outputs = fprop(initial_vars, prng_key, inputs, paddings,
+                          segment_mask, cross_inputs, cross_paddings,
+                          cross_segment_mask)
+    decoder_outputs = decode(initial_vars, prng_key, inputs, attention_mask,
+                             segment_mask, cross_inputs, cross_paddings,
+                             cross_segment_mask)
 
     decoder_out_transposed = jnp.transpose(decoder_outputs, [1, 0, 2])
     # TODO(lepikhin): remove noisy test logging
     # logging.info('initial_vars in transformer layer = %s', initial_vars)
-    np_fprop_outputs = test_utils.to_np(fprop_outputs)
-    np_decoder_outputs = test_utils.to_np(decoder_out_transposed)
+    np_fprop_outputs, np_decoder_outputs = jax.device_get(
+        (fprop_outputs, decoder_out_transposed))
     self.assertAllClose(np_fprop_outputs, np_decoder_outputs, atol=1e-5)
 
   @parameterized.parameters((True, True), (False, True), (True, False),
@@ -778,15 +881,13 @@ class TransformersTest(test_util.JaxTestCase):
     initial_vars = layer1.instantiate_variables(prng_key)
     layer2.instantiate_variable_configs()
 
-    npy_inputs = np.random.normal(
-        1.0, 0.5, [batch_size, seq_len, p1.model_dims]).astype('float32')
-    inputs = jnp.asarray(npy_inputs)
-    npy_paddings = np.random.randint(0, 1,
-                                     [batch_size, seq_len]).astype('float32')
-    paddings = jnp.asarray(npy_paddings)
+    npy_inputs, npy_paddings = _generate_inputs_and_paddings(
+        batch_size, seq_len, p1.model_dims)
+    inputs, paddings = jax.device_put((npy_inputs, npy_paddings))
     segment_mask = None
     if packed_input:
-      segment_ids = np.random.random_integers(0, 2, [batch_size, seq_len])
+      segment_ids = self._rng.integers(
+          0, 3, [batch_size, seq_len], dtype=np.int32)
       segment_mask = attentions.segment_mask(segment_ids, dtype=np.float32)
 
     cross_inputs = None
@@ -794,20 +895,16 @@ class TransformersTest(test_util.JaxTestCase):
     cross_segment_mask = None
     if cross_attention:
       cross_seq_len = np.random.randint(10, 32)
-      npy_cross_inputs = np.random.normal(
-          1.0, 0.5,
-          [batch_size, cross_seq_len, p1.model_dims]).astype('float32')
-      cross_inputs = jnp.asarray(npy_cross_inputs)
-      npy_cross_paddings = np.random.randint(
-          0, 1, [batch_size, cross_seq_len]).astype('float32')
-      cross_paddings = jnp.asarray(npy_cross_paddings)
+      npy_cross_inputs, npy_cross_paddings = _generate_inputs_and_paddings(
+          batch_size, cross_seq_len, p1.model_dims)
+      cross_inputs, cross_paddings = jax.device_put(
+          (npy_cross_inputs, npy_cross_paddings))
       if packed_input:
-        source_segment_ids = np.random.random_integers(
-            0, 2, [batch_size, cross_seq_len])
+        source_segment_ids = self._rng.integers(
+            0, 3, [batch_size, cross_seq_len], dtype=np.int32)
         cross_segment_mask = attentions.segment_mask(
             segment_ids, source_segment_ids, dtype=np.float32)
 
-    prng_key = jax.random.PRNGKey(seed=123)
     global_step = jnp.array(0, dtype=jnp.uint64)
     with base_layer.JaxContext.new_context(
         prng_key=prng_key, global_step=global_step):
@@ -831,8 +928,8 @@ class TransformersTest(test_util.JaxTestCase):
       for key, value in all_summaries.items():
         logging.info('summary: %s', f'key:{key}, value:{value}')
 
-    np_fprop_outputs_1 = test_utils.to_np(fprop_outputs_1)
-    np_fprop_outputs_2 = test_utils.to_np(fprop_outputs_2)
+    np_fprop_outputs_1, np_fprop_outputs_2 = jax.device_get(
+        (fprop_outputs_1, fprop_outputs_2))
     logging.info('np_fprop_outputs_1: %s', np_fprop_outputs_1)
     logging.info('np_fprop_outputs_2: %s', np_fprop_outputs_2)
     self.assertAllClose(np_fprop_outputs_1, np_fprop_outputs_2)
@@ -846,13 +943,14 @@ class TransformersTest(test_util.JaxTestCase):
         num_layers=1,
         vocab_size=52)
     p.softmax_tpl.scale_sqrt_depth = True
-    batch_size = 8
-    seq_len = 512
+    batch_size = 2
+    seq_len = 64
     bert_lm = p.Instantiate()
     prng_key = jax.random.PRNGKey(seed=123)
     initial_vars = bert_lm.instantiate_variables(prng_key)
-    input_ids = jax.random.randint(
-        jax.random.PRNGKey(1234), [batch_size, seq_len], 0, 51)
+    # Used both to sample the inputs and for the fprop context.
+    fprop_prng_key = jax.random.PRNGKey(seed=1234)
+    input_ids = jax.random.randint(fprop_prng_key, [batch_size, seq_len], 0, 51)
     input_paddings = jnp.zeros([batch_size, seq_len])
     input_weights = jnp.ones([batch_size, seq_len])
     input_segment_ids = jnp.ones([batch_size, seq_len])
@@ -864,8 +962,7 @@ class TransformersTest(test_util.JaxTestCase):
     labels.class_weights = input_weights
 
     with base_layer.JaxContext.new_context(
-        prng_key=jax.random.PRNGKey(seed=1234),
-        global_step=jnp.array(0, dtype=jnp.uint32)):
+        prng_key=fprop_prng_key, global_step=jnp.array(0, dtype=jnp.uint32)):
       outputs = bert_lm.fprop(
           initial_vars,
           input_ids,
@@ -882,17 +979,16 @@ class TransformersTest(test_util.JaxTestCase):
         input_dims=8,
         hidden_dims=32,
         activation=activation_function)
-    batch_size = 8
-    seq_len = 512
+    batch_size = 2
+    seq_len = 64
     ffwd = p.Instantiate()
     prng_key = jax.random.PRNGKey(seed=123)
     initial_vars = ffwd.instantiate_variables(prng_key)
 
     npy_inputs = np.random.normal(
         1.0, 0.5, [batch_size, seq_len, p.input_dims]).astype('float32')
-    inputs = jnp.asarray(npy_inputs)
     npy_paddings = np.zeros([batch_size, seq_len], dtype=np.float32)
-    input_paddings = jnp.asarray(npy_paddings)
+    inputs, input_paddings = jax.device_put((npy_inputs, npy_paddings))
 
     with base_layer.JaxContext.new_context(
         prng_key=jax.random.PRNGKey(seed=1234),
@@ -971,29 +1067,40 @@ class TransformersTest(test_util.JaxTestCase):
     transformer_lm = p.Instantiate()
     prng_key = jax.random.PRNGKey(seed=123)
     initial_vars = transformer_lm.instantiate_variables(prng_key)
-    initial_states = transformer_lm.init_states(initial_vars, batch_size,
-                                                seq_len)
     npy_inputs = np.random.randint(
         vocab_size, size=(batch_size, seq_len)).astype('int32')
     inputs = jnp.asarray(npy_inputs)
     context_params = base_layer.JaxContext.Params().Set(do_eval=True)
-    with base_layer.JaxContext.new_context(
-        params=context_params,
-        prng_key=prng_key,
-        global_step=jnp.array(0, dtype=jnp.uint32)):
-      transformer_lm.prepare_fprop()
-      fprop_outputs = transformer_lm.fprop(initial_vars, inputs,
-                                           jnp.zeros_like(inputs))
-      logits = fprop_outputs.logits
-      cached_states = initial_states
-      for t in range(seq_len):
-        if t > 0:
-          inputs_prefix = inputs[:, t - 1:t + 1]
-        else:
-          inputs_prefix = inputs[:, t]
+
+    @jax.jit
+    def fprop_and_decode(theta, prng_key, inputs):
+      initial_states = transformer_lm.init_states(theta, batch_size, seq_len)
+
+      def extend_step(cached_states, inputs_prefix):
         cached_states, xent_output = transformer_lm.extend_step(
-            initial_vars, cached_states, inputs_prefix)
-        self.assertAllClose(logits[:, t, :], xent_output.logits)
+            theta, cached_states, inputs_prefix)
+        return cached_states, xent_output.logits
+
+      with base_layer.JaxContext.new_context(
+          params=context_params,
+          prng_key=prng_key,
+          global_step=jnp.array(0, dtype=jnp.uint32)):
+        transformer_lm.prepare_fprop()
+        fprop_outputs = transformer_lm.fprop(theta, inputs,
+                                             jnp.zeros_like(inputs))
+        # The first step has no preceding token, so it is decoded on its own;
+        # every later step is fed the bigram ending at that step.
+        cached_states, first_logits = extend_step(initial_states, inputs[:, 0])
+        # [B, T - 1, 2] -> [T - 1, B, 2].
+        bigrams = jnp.transpose(
+            jnp.stack([inputs[:, :-1], inputs[:, 1:]], axis=-1), [1, 0, 2])
+        _, decode_logits = jax.lax.scan(extend_step, cached_states, bigrams)
+      return fprop_outputs.logits, jnp.concatenate(
+          [first_logits[jnp.newaxis], decode_logits], axis=0)
+
+    logits, decode_logits = fprop_and_decode(initial_vars, prng_key, inputs)
+    # [T, B, V] -> [B, T, V].
+    self.assertAllClose(logits, jnp.transpose(decode_logits, [1, 0, 2]))
 
   @parameterized.parameters(*list(itertools.product([True, False], repeat=2)))
   def test_primer_lm_extendstep(self, use_rotary_position_emb,
@@ -1017,35 +1124,45 @@ class TransformersTest(test_util.JaxTestCase):
       p.softmax_tpl = embedding_softmax.SingleShardFullSoftmax.Params()
     seq_len = 16
     batch_size = 3
-    # Turn on dconv as in Primer.
     params = p.stacked_transformer_tpl.transformer_layer_params_tpl
+    # Turn on dconv as in Primer.
     params.tr_atten_tpl.dconv_qkv = True
-    # Rotary position embedding.
-    params = p.stacked_transformer_tpl.transformer_layer_params_tpl
     params.tr_atten_tpl.dconv_kernel_size = dconv_kernel_size
+    # Rotary position embedding.
     params.tr_atten_tpl.use_rotary_position_emb = use_rotary_position_emb
     transformer_lm = p.Instantiate()
     prng_key = jax.random.PRNGKey(seed=123)
     initial_vars = transformer_lm.instantiate_variables(prng_key)
-    initial_states = transformer_lm.init_states(initial_vars, batch_size,
-                                                seq_len)
     npy_inputs = np.random.randint(
         vocab_size, size=(batch_size, seq_len)).astype('int32')
     inputs = jnp.asarray(npy_inputs)
     context_params = base_layer.JaxContext.Params().Set(do_eval=True)
-    with base_layer.JaxContext.new_context(
-        params=context_params,
-        prng_key=prng_key,
-        global_step=jnp.array(0, dtype=jnp.uint32)):
-      transformer_lm.prepare_fprop()
-      fprop_outputs = transformer_lm.fprop(initial_vars, inputs,
-                                           jnp.zeros_like(inputs))
-      logits = fprop_outputs.logits
-      cached_states = initial_states
-      for t in range(seq_len):
+
+    # Runs fprop and the whole decode, as a scan over the time-major inputs, in
+    # a single compiled program.
+    @jax.jit
+    def fprop_and_decode(theta, prng_key, inputs):
+      initial_states = transformer_lm.init_states(theta, batch_size, seq_len)
+
+      def extend_step(cached_states, inputs_t):
         cached_states, xent_output = transformer_lm.extend_step(
-            initial_vars, cached_states, inputs[:, t])
-        self.assertAllClose(logits[:, t, :], xent_output.logits)
+            theta, cached_states, inputs_t)
+        return cached_states, xent_output.logits
+
+      with base_layer.JaxContext.new_context(
+          params=context_params,
+          prng_key=prng_key,
+          global_step=jnp.array(0, dtype=jnp.uint32)):
+        transformer_lm.prepare_fprop()
+        fprop_outputs = transformer_lm.fprop(theta, inputs,
+                                             jnp.zeros_like(inputs))
+        _, decode_logits = jax.lax.scan(extend_step, initial_states,
+                                        jnp.transpose(inputs))
+      return fprop_outputs.logits, decode_logits
+
+    logits, decode_logits = fprop_and_decode(initial_vars, prng_key, inputs)
+    # [T, B, V] -> [B, T, V].
+    self.assertAllClose(logits, jnp.transpose(decode_logits, [1, 0, 2]))
 
   @parameterized.parameters(*list(itertools.product([True, False], repeat=3)))
   def test_ngrammer_primer_lm_extendstep(self, use_vq_ngrams,
@@ -1088,39 +1205,49 @@ class TransformersTest(test_util.JaxTestCase):
       p.softmax_tpl = embedding_softmax.SingleShardFullSoftmax.Params()
     seq_len = 8
     batch_size = 2
-    # Turn on dconv as in Primer.
     params = p.stacked_transformer_tpl.transformer_layer_params_tpl
+    # Turn on dconv as in Primer.
     params.tr_atten_tpl.dconv_qkv = True
     params.tr_atten_tpl.dconv_kernel_size = dconv_kernel_size
     # Rotary position embedding.
-    params = p.stacked_transformer_tpl.transformer_layer_params_tpl
     params.tr_atten_tpl.use_rotary_position_emb = use_rotary_position_emb
     transformer_lm = p.Instantiate()
     prng_key = jax.random.PRNGKey(seed=123)
     initial_vars = transformer_lm.instantiate_variables(prng_key)
-    initial_states = transformer_lm.init_states(initial_vars, batch_size,
-                                                seq_len)
     npy_inputs = np.random.randint(
         vocab_size, size=(batch_size, seq_len)).astype('int32')
     inputs = jnp.asarray(npy_inputs)
     context_params = base_layer.JaxContext.Params().Set(do_eval=True)
-    with base_layer.JaxContext.new_context(
-        params=context_params,
-        prng_key=prng_key,
-        global_step=jnp.array(0, dtype=jnp.uint32)):
-      transformer_lm.prepare_fprop()
-      fprop_outputs = transformer_lm.fprop(initial_vars, inputs,
-                                           jnp.zeros_like(inputs))
-      logits = fprop_outputs.logits
-      cached_states = initial_states
-      for t in range(seq_len):
-        if t > 0:
-          inputs_prefix = inputs[:, t - 1:t + 1]
-        else:
-          inputs_prefix = inputs[:, t]
+
+    @jax.jit
+    def fprop_and_decode(theta, prng_key, inputs):
+      initial_states = transformer_lm.init_states(theta, batch_size, seq_len)
+
+      def extend_step(cached_states, inputs_prefix):
         cached_states, xent_output = transformer_lm.extend_step(
-            initial_vars, cached_states, inputs_prefix)
-        self.assertAllClose(logits[:, t, :], xent_output.logits)
+            theta, cached_states, inputs_prefix)
+        return cached_states, xent_output.logits
+
+      with base_layer.JaxContext.new_context(
+          params=context_params,
+          prng_key=prng_key,
+          global_step=jnp.array(0, dtype=jnp.uint32)):
+        transformer_lm.prepare_fprop()
+        fprop_outputs = transformer_lm.fprop(theta, inputs,
+                                             jnp.zeros_like(inputs))
+        # The first step has no preceding token, so it is decoded on its own;
+        # every later step is fed the bigram ending at that step.
+        cached_states, first_logits = extend_step(initial_states, inputs[:, 0])
+        # [B, T - 1, 2] -> [T - 1, B, 2].
+        bigrams = jnp.transpose(
+            jnp.stack([inputs[:, :-1], inputs[:, 1:]], axis=-1), [1, 0, 2])
+        _, decode_logits = jax.lax.scan(extend_step, cached_states, bigrams)
+      return fprop_outputs.logits, jnp.concatenate(
+          [first_logits[jnp.newaxis], decode_logits], axis=0)
+
+    logits, decode_logits = fprop_and_decode(initial_vars, prng_key, inputs)
+    # [T, B, V] -> [B, T, V].
+    self.assertAllClose(logits, jnp.transpose(decode_logits, [1, 0, 2]))
 
   @parameterized.parameters(*list(itertools.product([True, False], repeat=9)))
   def test_transformer_encoder_decoder_extendstep(
@@ -1204,31 +1331,49 @@ class TransformersTest(test_util.JaxTestCase):
     npy_input_paddings = np.random.randint(0, 2, size=(batch_size, seq_len))
     npy_targets = np.random.randint(
         vocab_size, size=(batch_size, seq_len)).astype('int32')
-    inputs = jnp.asarray(npy_inputs)
-    input_paddings = jnp.asarray(npy_input_paddings)
-    targets = jnp.asarray(npy_targets)
+    inputs, input_paddings, targets = jax.device_put(
+        (npy_inputs, npy_input_paddings, npy_targets))
     context_params = base_layer.JaxContext.Params().Set(do_eval=True)
-    with base_layer.JaxContext.new_context(
-        params=context_params,
-        prng_key=prng_key,
-        global_step=jnp.array(0, dtype=jnp.uint32)):
-      transformer_enc_dec.prepare_fprop()
-      initial_states = transformer_enc_dec.init_states(initial_vars, inputs,
-                                                       input_paddings,
-                                                       batch_size, seq_len)
-      fprop_outputs = transformer_enc_dec.fprop(initial_vars, inputs,
-                                                input_paddings, targets,
-                                                jnp.zeros_like(targets))
-      logits = fprop_outputs.logits
-      cached_states = initial_states
-      for t in range(seq_len):
-        targets_prefix = targets[:, t]
-        if use_decoder_ngrams or use_decoder_vq_ngrams:
-          if t > 0:
-            targets_prefix = targets[:, t - 1:t + 1]
+
+    @jax.jit
+    def fprop_and_decode(theta, prng_key, inputs, input_paddings, targets):
+
+      def extend_step(cached_states, targets_prefix):
         cached_states, xent_output = transformer_enc_dec.extend_step(
-            initial_vars, cached_states, targets_prefix)
-        self.assertAllClose(logits[:, t, :], xent_output.logits)
+            theta, cached_states, targets_prefix)
+        return cached_states, xent_output.logits
+
+      with base_layer.JaxContext.new_context(
+          params=context_params,
+          prng_key=prng_key,
+          global_step=jnp.array(0, dtype=jnp.uint32)):
+        transformer_enc_dec.prepare_fprop()
+        initial_states = transformer_enc_dec.init_states(
+            theta, inputs, input_paddings, batch_size, seq_len)
+        fprop_outputs = transformer_enc_dec.fprop(theta, inputs,
+                                                  input_paddings, targets,
+                                                  jnp.zeros_like(targets))
+        if use_decoder_ngrams or use_decoder_vq_ngrams:
+          # The first step has no preceding token, so it is decoded on its
+          # own; every later step is fed the bigram ending at that step.
+          cached_states, first_logits = extend_step(initial_states,
+                                                    targets[:, 0])
+          # [B, T - 1, 2] -> [T - 1, B, 2].
+          bigrams = jnp.transpose(
+              jnp.stack([targets[:, :-1], targets[:, 1:]], axis=-1),
+              [1, 0, 2])
+          _, decode_logits = jax.lax.scan(extend_step, cached_states, bigrams)
+          decode_logits = jnp.concatenate(
+              [first_logits[jnp.newaxis], decode_logits], axis=0)
+        else:
+          _, decode_logits = jax.lax.scan(extend_step, initial_states,
+                                          jnp.transpose(targets))
+      return fprop_outputs.logits, decode_logits
+
+    logits, decode_logits = fprop_and_decode(initial_vars, prng_key, inputs,
+                                             input_paddings, targets)
+    # [T, B, V] -> [B, T, V].
+    self.assertAllClose(logits, jnp.transpose(decode_logits, [1, 0, 2]))
 
   @parameterized.parameters(['pre', 'primer_hybrid'])
   def test_transformer_layer_norm_policies(self, norm_policy):
@@ -1246,18 +1391,12 @@ class TransformersTest(test_util.JaxTestCase):
     transformer_layer = p.Instantiate()
     prng_key = jax.random.PRNGKey(seed=123)
     initial_vars = transformer_layer.instantiate_variables(prng_key)
-    npy_inputs = np.random.normal(
-        1.0, 0.5, [batch_size, seq_len, p.input_dims]).astype('float32')
-    inputs = jnp.asarray(npy_inputs)
-    npy_paddings = np.random.randint(0, 1,
-                                     [batch_size, seq_len]).astype('float32')
-    paddings = jnp.asarray(npy_paddings)
-    attention_mask = attentions.convert_paddings_to_mask(paddings)
-    causal_mask = attentions.causal_mask(inputs)
-    attention_mask = jnp.minimum(attention_mask, causal_mask)
-    segment_ids = np.random.random_integers(0, 2, [batch_size, seq_len])
-    segment_mask = attentions.segment_mask(segment_ids, dtype=np.float32)
-    attention_mask = jnp.minimum(attention_mask, segment_mask)
+    npy_inputs, npy_paddings = _generate_inputs_and_paddings(
+        batch_size, seq_len, p.input_dims)
+    inputs, paddings = jax.device_put((npy_inputs, npy_paddings))
+    segment_ids = self._rng.integers(
+        0, 3, [batch_size, seq_len], dtype=np.int32)
+    attention_mask = _compute_attention_mask(paddings, segment_ids)
 
     with base_layer.JaxContext.new_context(
         prng_key=prng_key, global_step=jnp.array(0, dtype=jnp.uint32)):
@@ -1271,4 +1410,8 @@ class TransformersTest(test_util.JaxTestCase):
 
 
 if __name__ == '__main__':
+  # Lets repeated runs of these heavily parameterized tests reuse the XLA
+  # programs compiled by a previous run.
+  compilation_cache.initialize_cache(
+      os.path.join(tempfile.gettempdir(), 'lingvo_jax_transformers_test_cache'))
   absltest.main()
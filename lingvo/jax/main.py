@@ -35,6 +35,7 @@ from absl import logging
 from clu import platform
 import jax
 from jax import prng
+from jax.experimental.compilation_cache import compilation_cache
 from lingvo.jax import checkpoints
 from lingvo.jax import eval as eval_lib
 from lingvo.jax import train
@@ -77,6 +78,11 @@ flags.DEFINE_integer(
     'jax_profiler_port', None,
     'If set, the jax.profiler port to use. Only needed for profiling in open source.'
 )
+flags.DEFINE_bool(
+    'persistent_compilation_cache', False,
+    'If True, persist the compiled XLA programs under --job_log_dir\'s '
+    '`jit_cache` subdirectory, so that restarted jobs (e.g. continuous eval) '
+    'skip compilation for the programs compiled by a previous run.')
 # Flag --jax_parallel_functions_output_gda is available through JAX.
 # Flags --jax_backend_target and --jax_xla_backend are available through JAX.
 
@@ -94,7 +100,8 @@ def globally_use_rbg_prng_key() -> None:
 
 def setup_jax(globally_use_hardware_rng: bool, jax_use_gda: bool,
               jax_backend_target: Optional[str],
-              jax_xla_backend: Optional[str]) -> None:
+              jax_xla_backend: Optional[str],
+              compilation_cache_dir: Optional[str] = None) -> None:
   """Setups JAX and logs information about this job."""
   # Hide any GPUs from TensorFlow. Otherwise TF might reserve memory and make
   # it unavailable to JAX.
@@ -111,6 +118,11 @@ def setup_jax(globally_use_hardware_rng: bool, jax_use_gda: bool,
     jax_xla_backend = 'None' if jax_xla_backend is None else jax_xla_backend
     logging.info('Using JAX XLA backend %s', jax_xla_backend)
 
+  if compilation_cache_dir:
+    logging.info('Using JAX persistent compilation cache %s',
+                 compilation_cache_dir)
+    compilation_cache.initialize_cache(compilation_cache_dir)
+
   logging.info('JAX process: %d / %d', jax.process_index(), jax.process_count())
   logging.info('JAX devices: %r', jax.devices())
   logging.info('jax.device_count(): %d', jax.device_count())
@@ -127,9 +139,12 @@ def main(argv: Sequence[str]) -> None:
   if len(argv) > 1:
     raise app.UsageError('Too many command-line arguments.')
 
+  compilation_cache_dir = None
+  if FLAGS.persistent_compilation_cache and FLAGS.job_log_dir:
+    compilation_cache_dir = os.path.join(FLAGS.job_log_dir, 'jit_cache')
   setup_jax(FLAGS.globally_use_hardware_rng,
             FLAGS.jax_parallel_functions_output_gda, FLAGS.jax_backend_target,
-            FLAGS.jax_xla_backend)
+            FLAGS.jax_xla_backend, compilation_cache_dir)
 
   # Add a note so that we can tell which Borg task is which JAX host.
   # (Borg task 0 is not guaranteed to be host 0)
@@ -15,7 +15,7 @@
 # ==============================================================================
 """Utility functions for computing metrics."""
 
-from typing import Optional
+from typing import List, Optional, Sequence
 
 import jax
 from jax import numpy as jnp
@@ -46,6 +46,35 @@ def top_k_accuracy(top_k: int,
   Returns:
     The top-k accuracy represented as a `JTensor`.
 
+  Raises:
+    ValueError if neither `label_ids` nor `label_probs` are provided.
+  """
+  return top_k_accuracies([top_k], logits, label_ids, label_probs, weights)[0]
+
+
+def top_k_accuracies(top_ks: Sequence[int],
+                     logits: JTensor,
+                     label_ids: Optional[JTensor] = None,
+                     label_probs: Optional[JTensor] = None,
+                     weights: Optional[JTensor] = None) -> List[JTensor]:
+  """Computes the top-k accuracies for several values of k at once.
+
+  A single top-k over the logits, for the largest k, is shared by all values.
+
+  Args:
+    top_ks: A sequence of ints, specifying the values of top-k.
+    logits: A [..., C] float tensor corresponding to the logits.
+    label_ids: A [...] int vector corresponding to the class labels. One of
+      label_ids and label_probs should be presented.
+    label_probs: A [..., C] float vector corresponding to the class
+      probabilites. Must be presented if label_ids is None.
+    weights: A [...] float vector corresponding to the weight to assign to each
+      example.
+
+  Returns:
+    A list with the top-k accuracy for each value in `top_ks`, each represented
+    as a `JTensor`.
+
   Raises:
     ValueError if neither `label_ids` nor `label_probs` are provided.
   """
@@ -54,8 +83,9 @@ def top_k_accuracy(top_k: int,
   if label_ids is None:
     label_ids = jnp.argmax(label_probs, axis=-1)
 
-  values, _ = jax.lax.top_k(logits, k=top_k)
-  threshold = jnp.min(values, axis=-1)
+  # The values are sorted in descending order, so the threshold of top-k is the
+  # k-th largest value.
+  values, _ = jax.lax.top_k(logits, k=max(top_ks))
 
   # Reshape logits to [-1, C].
   logits_reshaped = jnp.reshape(logits, [-1, logits.shape[-1]])
@@ -67,7 +97,10 @@ def top_k_accuracy(top_k: int,
 
   # Reshape logits_slice back to original shape to be compatible with weights.
   logits_slice = jnp.reshape(logits_slice, label_ids.shape)
-  correct = jnp.greater_equal(logits_slice, threshold)
-  correct_sum = jnp.sum(correct * weights)
   all_sum = jnp.maximum(1.0, jnp.sum(weights))
-  return correct_sum / all_sum
+  accuracies = []
+  for top_k in top_ks:
+    correct = jnp.greater_equal(logits_slice, values[..., top_k - 1])
+    correct_sum = jnp.sum(correct * weights)
+    accuracies.append(correct_sum / all_sum)
+  return accuracies
@@ -335,6 +335,8 @@ def train_and_evaluate_pmap(model_p: InstantiableParams,
           else:
             mllogger.log_block_start(step_i)
       logging.debug('step=`%d`: End', step_i - 1)
+    # Make sure the last checkpoint is fully written before returning.
+    checkpoints.checkpoint_wait()
 
 
 def train_and_evaluate_spmd_model(model_p: InstantiableParams,
@@ -598,3 +600,5 @@ def train_and_evaluate_spmd_model(model_p: InstantiableParams,
             else:
               mllogger.log_block_start(step_i)
         logging.debug('step=`%d`: End', step_i - 1)
+      # Make sure the last checkpoint is fully written before returning.
+      checkpoints.checkpoint_wait()
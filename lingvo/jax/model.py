@@ -15,6 +15,7 @@
 # ==============================================================================
 """Base class for all Jax models."""
 
+from concurrent import futures
 from typing import Any, Dict, Optional, Sequence, Tuple, Union
 
 import jax
@@ -48,6 +49,10 @@ _UNPARTITIONED_BASENAME = 'unpartitioned.msgpack'
 _PARTITIONED_SUBDIR = 'partitioned'
 _CHECKPOINT_PREFIX = 'ckpt'
 
+# Background workers detokenizing the decoded, original and prefix ids of a
+# decode batch concurrently. The tokenizer ops release the GIL.
+_IDS_TO_STRINGS_EXECUTOR = futures.ThreadPoolExecutor(max_workers=3)
+
 
 def compute_xent_loss_helper(
     predictions: NestedMap, input_batch: NestedMap,
@@ -75,9 +80,9 @@ def compute_xent_loss_helper(
   weights = input_batch.weights
   predicted_labels = predictions.per_example_argmax.astype(labels.dtype)
   num_preds = predictions.total_weight
-  mean_acc = jnp.sum(
-      (labels == predicted_labels) * weights) / jnp.maximum(num_preds, 1)
-  metric_weight = jnp.array(num_preds, predictions.avg_xent.dtype)
+  correct = (labels == predicted_labels).astype(weights.dtype)
+  mean_acc = jnp.sum(correct * weights) / jnp.maximum(num_preds, 1)
+  metric_weight = num_preds.astype(predictions.avg_xent.dtype)
   metrics = NestedMap(
       total_loss=(predictions.total_loss, metric_weight),
       avg_xent=(predictions.avg_xent, metric_weight),
@@ -292,8 +297,8 @@ class BaseTask(base_layer.BaseLayer):
     """
     # Make a private copy of mdl_vars and var_weight_params structures that are
     # not shared with the caller.
-    mdl_vars = tf.nest.map_structure(lambda x: x, mdl_vars)
-    var_weight_params = tf.nest.map_structure(lambda x: x, var_weight_params)
+    mdl_vars = jax.tree_map(lambda x: x, mdl_vars)
+    var_weight_params = jax.tree_map(lambda x: x, var_weight_params)
     learners = self.learners
     grad_txs = [x.get_grad_tx(mdl_vars=mdl_vars) for x in learners]
     tf.nest.assert_same_structure(mdl_vars, var_weight_params)
@@ -396,52 +401,47 @@ class LanguageModel(BaseTask):
                                         input_batch.ids.dtype)
     decoder_state = self.lm.init_states(
         theta.lm, target_batch_size=batch_size, target_max_length=max_length)
-    output_ids = jnp.zeros(shape=(batch_size, max_length), dtype=jnp.int32)
-    output_ids = output_ids.at[:, 0].set(input_batch.ids[:, 0])
-
-    val = py_utils.NestedMap()
-    val.state = decoder_state
-    val.step = 0
-    val.output_ids = output_ids
 
-    def loop_body(val):
-      """From ids at `step`, update output ids at `step + 1`."""
-      step = val.step
+    def loop_body(carry, step):
+      """From the ids at `step`, computes the output ids at `step + 1`."""
+      decoder_state, last_ids = carry
       decoder_state, xent_output = self.lm.extend_step(
-          theta.lm, val.state, inputs=val.output_ids[:, step])
-      val.state = decoder_state
+          theta.lm, decoder_state, inputs=last_ids)
       # When step becomes prefix_length - 1, the new output has index beyond
       # the known prefix.
       new_ids = jnp.where(step < prefix_lengths - 1, input_batch.ids[:,
                                                                      step + 1],
                           jnp.argmax(xent_output.logits, axis=1))
-      val.output_ids = val.output_ids.at[:, step + 1].set(new_ids)
-      val.step = val.step + 1
-      return val
+      new_ids = new_ids.astype(jnp.int32)
+      return (decoder_state, new_ids), new_ids
 
     # TODO(b/198356509): currently we rely on the underlying layers' correctness
     # test, e.g. extend_step() is equivalent with fprop(). Improve testing of
     # the correctness of a model's decode() implementation.
-    result = jax.lax.while_loop(lambda val: val.step < max_length - 1,
-                                loop_body, val)
-    result.prefix_lengths = prefix_lengths
-    result.decode_lengths = jnp.ones_like(prefix_lengths) * max_length
-    result.original_lengths = jnp.sum(
-        1.0 - input_batch.paddings, axis=1).astype(prefix_lengths.dtype)
+    # Only the last ids are carried from step to step; the scan stacks the new
+    # ids of every step into a single [max_length - 1, batch_size] output.
+    first_ids = input_batch.ids[:, 0].astype(jnp.int32)
+    _, new_ids = jax.lax.scan(loop_body, (decoder_state, first_ids),
+                              jnp.arange(max_length - 1))
+    output_ids = jnp.concatenate(
+        [first_ids[:, jnp.newaxis], jnp.transpose(new_ids)], axis=1)
 
     prefix_ids = input_batch.ids
     # We manually pad out the ids not belong to the prefix because some
     # tokenizers tested do not always obey the lengths arg.
-    indices = jnp.tile(
-        jnp.arange(prefix_ids.shape[1]), (prefix_ids.shape[0], 1))
-    prefix_lengths_2d = jnp.tile(prefix_lengths[:, None],
-                                 (1, prefix_ids.shape[1]))
-    prefix_ids = jnp.where(indices < prefix_lengths_2d, prefix_ids,
-                           jnp.zeros_like(prefix_ids))
-    result.prefix_ids = prefix_ids
-
-    del result.state
-    del result.step
+    prefix_mask = (
+        jnp.arange(prefix_ids.shape[1])[jnp.newaxis, :] <
+        prefix_lengths[:, jnp.newaxis])
+    prefix_ids = jnp.where(prefix_mask, prefix_ids,
+                           jnp.array(0, dtype=prefix_ids.dtype))
+
+    result = py_utils.NestedMap(
+        output_ids=output_ids,
+        prefix_lengths=prefix_lengths,
+        decode_lengths=jnp.full_like(prefix_lengths, max_length),
+        # `maxval` already holds the unpadded length of each row.
+        original_lengths=maxval.astype(prefix_lengths.dtype),
+        prefix_ids=prefix_ids)
     result.update(input_batch)
     return result
 
@@ -457,12 +457,13 @@ class LanguageModel(BaseTask):
       A dict where each entry corresponds to a row in the batch. The keys should
       be unique across the entire decode dataset.
     """
-    decoded_strs = input_obj.ids_to_strings(decode_out.output_ids,
-                                            decode_out.decode_lengths)
-    original_strs = input_obj.ids_to_strings(decode_out.ids,
-                                             decode_out.original_lengths)
-    prefix_strs = input_obj.ids_to_strings(decode_out.prefix_ids,
-                                           decode_out.prefix_lengths)
+    pending = [
+        _IDS_TO_STRINGS_EXECUTOR.submit(input_obj.ids_to_strings, ids, lengths)
+        for ids, lengths in ((decode_out.output_ids, decode_out.decode_lengths),
+                             (decode_out.ids, decode_out.original_lengths),
+                             (decode_out.prefix_ids, decode_out.prefix_lengths))
+    ]
+    decoded_strs, original_strs, prefix_strs = [f.result() for f in pending]
     ret = list()
     for idx, decoded_str in enumerate(decoded_strs):
       ret.append((prefix_strs[idx], {
@@ -620,13 +621,8 @@ class ClassificationTask(BaseTask):
         num_predictions=(total_weight, jnp.array(1.0, total_weight.dtype)))
     if self.do_eval:
       # Compute top-1 and top-5 accuracy and add summary.
-      acc1 = metric_utils.top_k_accuracy(
-          1,
-          predictions.softmax_output.logits,
-          label_probs=input_batch.label_probs,
-          weights=predictions.example_weights)
-      acc5 = metric_utils.top_k_accuracy(
-          5,
+      acc1, acc5 = metric_utils.top_k_accuracies(
+          [1, 5],
           predictions.softmax_output.logits,
           label_probs=input_batch.label_probs,
           weights=predictions.example_weights)
@@ -662,7 +658,11 @@ class BertModel(BaseTask):
     assert p.lm.masked_lm
     assert p.lm.packed_input
 
-    self.create_child('lm', p.lm)
+    lm_p = p.lm.Copy()
+    if p.label_smoothing_prob > 0.0:
+      # The softmax smooths the targets from the label ids directly.
+      lm_p.softmax_tpl.label_smoothing_prob = p.label_smoothing_prob
+    self.create_child('lm', lm_p)
 
     mlm_augment_p = layers.MaskedLmDataAugmenter.Params()
     mlm_augment_p.vocab_size = p.lm.vocab_size
@@ -687,19 +687,9 @@ class BertModel(BaseTask):
       augmented_labels, augmented_pos = self.mlm_augmenter.fprop(
           theta.mlm_augmenter, labels, paddings)
 
-    if p.label_smoothing_prob > 0.0:
-      class_probabilities = jax.nn.one_hot(labels, p.lm.vocab_size)
-      fill_prob = p.label_smoothing_prob / (p.lm.vocab_size - 1)
-      class_probabilities = (
-          (1.0 - p.label_smoothing_prob) * class_probabilities + fill_prob *
-          (1.0 - class_probabilities)).astype(self.fprop_dtype)
-
-      # Only compute loss on masked pos.
-      labels = NestedMap(
-          class_probabilities=class_probabilities, class_weights=augmented_pos)
-    else:
-      # Only compute loss on masked pos.
-      labels = NestedMap(class_ids=labels, class_weights=augmented_pos)
+    # Only compute loss on masked pos. Label smoothing, if any, is applied by
+    # the softmax layer.
+    labels = NestedMap(class_ids=labels, class_weights=augmented_pos)
 
     lm_out = self.lm.fprop(
         theta=theta.lm,
@@ -735,16 +725,16 @@ class BertModel(BaseTask):
     weights = predictions.augmented_pos.astype(jnp.float32)
     predicted_labels = predictions.per_example_argmax.astype(labels.dtype)
     num_preds = predictions.total_weight.astype(jnp.float32)
-    mean_acc = jnp.sum(
-        (labels == predicted_labels) * weights) / jnp.maximum(num_preds, 1)
-    metric_weight = jnp.array(num_preds, predictions.avg_xent.dtype)
+    correct = (labels == predicted_labels).astype(weights.dtype)
+    mean_acc = jnp.sum(correct * weights) / jnp.maximum(num_preds, 1)
+    metric_weight = num_preds.astype(predictions.avg_xent.dtype)
     metrics = py_utils.NestedMap(
         total_loss=(predictions.total_loss, metric_weight),
         avg_xent=(predictions.avg_xent, metric_weight),
         aux_loss=(predictions.aux_loss, metric_weight),
         log_pplx=(predictions.avg_xent, metric_weight),
-        fraction_of_correct_preds=(mean_acc, jnp.array(num_preds,
-                                                       mean_acc.dtype)),
+        fraction_of_correct_preds=(mean_acc,
+                                   num_preds.astype(mean_acc.dtype)),
         num_predictions=(num_preds, jnp.array(1.0, num_preds.dtype)),
         num_tokens=(num_tokens, jnp.array(1.0, num_tokens.dtype)),
         num_seqs=(num_seqs, jnp.array(1.0, num_seqs.dtype)),
@@ -54,6 +54,7 @@ REQUIRED_PACKAGES = [
     'tensorflow~=' + tf.__version__,
     'tensorflow-hub',
     'tensorflow-text',
+    'tensorstore',
 ]
 
 
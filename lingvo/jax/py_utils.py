@@ -55,19 +55,23 @@ del hyperparams
 # No more imports from lingvo should be accessed by core JAX library.
 
 
-# A utility function to flatten copied from third_party/py/jax/_src/util.py
-def _unzip2(xys):
-  xs = []
-  ys = []
-  for x, y in xys:
-    xs.append(x)
-    ys.append(y)
-  return tuple(xs), tuple(ys)
-
-
-jax.tree_util.register_pytree_node(NestedMap,
-                                   lambda xs: _unzip2(sorted(xs.items()))[::-1],
-                                   lambda keys, xs: NestedMap(zip(keys, xs)))
+def _nested_map_flatten(xs):
+  """Flattens a NestedMap into its values and sorted keys."""
+  keys = tuple(sorted(xs.keys()))
+  return tuple(dict.__getitem__(xs, k) for k in keys), keys
+
+
+def _nested_map_unflatten(keys, xs):
+  """Rebuilds a NestedMap from the output of `_nested_map_flatten`."""
+  nmap = NestedMap()
+  # The keys come from a flattened NestedMap and are already valid, so this
+  # skips the per-key checks of NestedMap.__init__ and __setitem__.
+  dict.update(nmap, zip(keys, xs))
+  return nmap
+
+
+jax.tree_util.register_pytree_node(NestedMap, _nested_map_flatten,
+                                   _nested_map_unflatten)
 
 
 @functools.partial(functools.partial, jax.tree_map)
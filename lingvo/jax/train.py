@@ -327,6 +327,8 @@ def train_and_evaluate_pmap(
               reshard_inputs=True)
         logging.debug('  Completed eval_step() runs on test splits.')
       logging.debug('step=`%d`: End', step_i - 1)
+    # Make sure the last checkpoint is fully written before returning.
+    checkpoints.checkpoint_wait()
 
 
 def train_and_evaluate_spmd_model(
@@ -491,6 +493,11 @@ def train_and_evaluate_spmd_model(
         if summary_last_step is None:
           summary_last_step = step_i - 1
 
+        if multi_host_checkpointing or jax.process_index() == 0:
+          # Commit the previous checkpoint shortly after it has been written, so
+          # that it survives a preemption before the next save.
+          checkpoints.maybe_commit_checkpoint()
+
         if step_i % train_p.save_interval_steps == 0:
           logging.info('Saving a ckpt at step: %d', step_i)
           if multi_host_checkpointing:
@@ -588,3 +595,5 @@ def train_and_evaluate_spmd_model(
             logging.debug('  Completed eval_step() runs on test splits.')
 
         logging.debug('step=`%d`: End', step_i - 1)
+      # Make sure the last checkpoint is fully written before returning.
+      checkpoints.checkpoint_wait()